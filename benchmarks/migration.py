@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+"""
+Migration throughput benchmark.
+
+Starts local cluster-enabled redis-server processes, loads keys and times
+create, add, reshard and remove. Results are written as JSON, use --output
+to keep them apart from the migration log.
+
+    python benchmarks/migration.py --masters 3 --keys 100000 \
+        --keyMigrationCount auto --output bench.json
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import redis  # noqa
+
+from redisclu.cli.helper import ClusterCreator  # noqa
+from redisclu.cluster import Cluster  # noqa
+from redisclu.node import Node  # noqa
+from redisclu.topology import Topology  # noqa
+
+
+def crc16(data):
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+
+def key_slot(key):
+    start = key.find('{')
+    if start > -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key.encode('utf-8')) % Cluster.CLUSTER_HASH_SLOTS
+
+
+class RedisServers(object):
+    def __init__(self, binary, base_port, count):
+        self.binary = binary
+        self.ports = list(range(base_port, base_port + count))
+        self.directory = tempfile.mkdtemp(prefix='redis-clu-bench-')
+        self.processes = []
+
+    def __enter__(self):
+        devnull = open(os.devnull, 'w')
+        for port in self.ports:
+            self.processes.append(subprocess.Popen([
+                self.binary, '--port', str(port),
+                '--cluster-enabled', 'yes',
+                '--cluster-config-file', 'nodes-{}.conf'.format(port),
+                '--dir', self.directory,
+                '--save', '', '--appendonly', 'no',
+            ], stdout=devnull, stderr=devnull))
+        for port in self.ports:
+            self._wait_ready(port)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return False
+
+    def _wait_ready(self, port, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                redis.Redis('127.0.0.1', port).ping()
+                return
+            except redis.ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    @property
+    def uris(self):
+        return ['127.0.0.1:{}'.format(port) for port in self.ports]
+
+    def commands(self):
+        return sum(redis.Redis('127.0.0.1', port).info('stats')
+                   ['total_commands_processed'] for port in self.ports)
+
+
+def value_sizes(args):
+    if args.value_distribution == 'exponential':
+        return lambda: max(1, int(random.expovariate(1.0 / args.value_size)))
+    return lambda: args.value_size
+
+
+def load_keys(cluster, args):
+    owners = {}
+    for master in cluster.masters:
+        for slot in master.slots:
+            owners[slot] = master
+
+    size = value_sizes(args)
+    pipelines = {}
+    for i in range(args.keys):
+        key = 'key:{}'.format(i)
+        master = owners[key_slot(key)]
+        pipeline = pipelines.get(master)
+        if pipeline is None:
+            pipeline = pipelines[master] = master.redis.pipeline(
+                transaction=False)
+        pipeline.set(key, 'x' * size())
+        if len(pipeline) >= 1000:
+            pipeline.execute()
+    for pipeline in pipelines.values():
+        pipeline.execute()
+
+
+def configure(cluster, args):
+    count = args.keyMigrationCount
+    cluster.set_key_migration_count(count if count == 'auto' else int(count))
+    cluster.set_key_migration_mode(args.keyMigrationMode)
+    cluster.set_migration_concurrency(args.sourceConcurrency,
+                                      args.destinationConcurrency)
+    cluster.set_wait_timeout(60)
+    return cluster
+
+
+def measure(servers, func):
+    commands = servers.commands()
+    round_trips = Topology.round_trips
+    start = time.time()
+    keys, slots = func()
+    wall_time = time.time() - start
+    result = {
+        'wall_time': round(wall_time, 4),
+        'commands': servers.commands() - commands,
+        'cluster_nodes_round_trips': Topology.round_trips - round_trips,
+    }
+    if keys is not None:
+        result.update({
+            'keys': keys,
+            'slots': slots,
+            'keys_per_sec': round(keys / wall_time, 2),
+            'slots_per_sec': round(slots / wall_time, 2),
+        })
+    return result
+
+
+def run(args):
+    results = {'config': vars(args), 'phases': {}}
+    phases = results['phases']
+
+    with RedisServers(args.redis_server, args.port, args.masters + 2) as s:
+        uris = s.uris
+        masters, added, extra = uris[:-2], uris[-2], uris[-1]
+
+        def create():
+            creator = ClusterCreator(masters)
+            assert creator.check(), 'redis servers are not empty'
+            creator.initialize_slots()
+            creator.bind_slots()
+            creator.bind_config_epoch()
+            creator.join_cluster()
+            creator.cluster.wait(timeout=60)
+            return None, None
+
+        phases['create'] = measure(s, create)
+
+        cluster = configure(Cluster.from_node(Node.from_uri(masters[0])),
+                            args)
+        start = time.time()
+        load_keys(cluster, args)
+        phases['load'] = {'wall_time': round(time.time() - start, 4),
+                          'keys': args.keys}
+
+        def add():
+            cluster = configure(
+                Cluster.from_node(Node.from_uri(masters[0])), args)
+            cluster.add_node(added)
+            cluster.reshard()
+            cluster.wait()
+            node = Node.from_uri(added)
+            return node.dbsize(), len(node.slots)
+
+        phases['add'] = measure(s, add)
+
+        cluster = configure(Cluster.from_node(Node.from_uri(masters[0])),
+                            args)
+        cluster.add_node(extra)
+
+        def reshard():
+            cluster = configure(
+                Cluster.from_node(Node.from_uri(masters[0])), args)
+            cluster.reshard()
+            cluster.wait()
+            node = Node.from_uri(extra)
+            return node.dbsize(), len(node.slots)
+
+        phases['reshard'] = measure(s, reshard)
+
+        def remove():
+            cluster = configure(
+                Cluster.from_node(Node.from_uri(masters[0])), args)
+            node = Node.from_uri(extra)
+            keys, slots = node.dbsize(), len(node.slots)
+            cluster.remove_node(node)
+            cluster.wait()
+            return keys, slots
+
+        phases['remove'] = measure(s, remove)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--masters', type=int, default=3)
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--value-size', type=int, default=64)
+    parser.add_argument('--value-distribution', default='fixed',
+                        choices=['fixed', 'exponential'])
+    parser.add_argument('--port', type=int, default=7100)
+    parser.add_argument('--redis-server', default='redis-server')
+    parser.add_argument('--keyMigrationCount', default='auto')
+    parser.add_argument('--keyMigrationMode', default='keys',
+                        choices=['keys', 'single'])
+    parser.add_argument('--sourceConcurrency', type=int, default=2)
+    parser.add_argument('--destinationConcurrency', type=int, default=2)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output == '-':
+        print(results)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+"""
+CLUSTER NODES parser benchmark.
+
+Builds a synthetic CLUSTER NODES reply and compares parse time and
+retained memory of the former dict per node parser with NodeRecord.
+No redis-server is needed.
+
+    python benchmarks/topology.py --nodes 1000 --fragments 4 --repeat 20
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from redisclu.slots import SlotRanges  # noqa
+from redisclu.topology import parse_nodes  # noqa
+
+HASH_SLOTS = 16384
+
+
+def dict_parser(nodes):
+    """
+    Node._parse_node before NodeRecord.
+    """
+    data = []
+    for item in nodes.split('\n'):
+        if not item:
+            continue
+        confs = item.split()
+        node_info = {
+            'name': confs[0],
+            'addr': confs[1].split('@')[0],
+            'flags': confs[2].split(','),
+            'replicate': confs[3],
+            'ping_sent': int(confs[4]),
+            'ping_recv': int(confs[5]),
+            'link_status': confs[7],
+            'migrating': {},
+            'importing': {},
+        }
+        ranges = []
+        for slot in confs[8:]:
+            if slot[0] == '[':
+                if '->-' in slot:
+                    s, dst = slot[1:-1].split('->-')
+                    node_info['migrating'][s] = dst
+                elif '-<-' in slot:
+                    s, src = slot[1:-1].split('-<-')
+                    node_info['importing'][s] = src
+            elif '-' in slot:
+                start, end = slot.split('-')
+                ranges.append((int(start), int(end)))
+            else:
+                ranges.append((int(slot), int(slot)))
+        node_info['slots'] = SlotRanges(ranges)
+
+        if 'myself' in node_info['flags']:
+            data.insert(0, node_info)
+        else:
+            data.append(node_info)
+    return data
+
+
+def reply(count, fragments, seed=0):
+    """
+    Half masters half slaves, every master owns `fragments` slot ranges,
+    myself is the last line.
+    """
+    rnd = random.Random(seed)
+    masters = max(count // 2, 1)
+    names = ['{:040x}'.format(rnd.getrandbits(160)) for _ in range(count)]
+
+    bounds = sorted(rnd.sample(range(1, HASH_SLOTS), masters * fragments - 1))
+    bounds = [0] + bounds + [HASH_SLOTS]
+    ranges = [(bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1)]
+    rnd.shuffle(ranges)
+
+    lines = []
+    for i, name in enumerate(names):
+        addr = '10.0.{}.{}:6379@16379'.format(i // 250, i % 250)
+        flags = 'myself,' if i == count - 1 else ''
+        if i < masters:
+            slots = ' '.join(str(s) if s == e else '{}-{}'.format(s, e)
+                             for s, e in ranges[i::masters])
+            lines.append('{} {} {}master - 0 1500000000{:03d} {} connected '
+                         '{}'.format(name, addr, flags, i % 1000, i + 1,
+                                     slots))
+        else:
+            lines.append('{} {} {}slave {} 0 1500000000{:03d} {} '
+                         'connected'.format(name, addr, flags,
+                                            names[i % masters], i % 1000,
+                                            i % masters + 1))
+    return '\n'.join(lines) + '\n'
+
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(i, seen) for i in obj)
+    elif hasattr(obj, '__slots__'):
+        for cls in type(obj).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if hasattr(obj, attr):
+                    size += deep_size(getattr(obj, attr), seen)
+    return size
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench(parser, data, repeat):
+    def names():
+        return [(n['name'], n['flags']) for n in parser(data)]
+
+    def slots():
+        return [len(n['slots']) for n in parser(data)]
+
+    parsed = parser(data)
+    assert 'myself' in parsed[0]['flags']
+    retained = deep_size(parsed)
+    for n in parsed:
+        n['slots']
+    return {
+        'parse': round(timed(lambda: parser(data), repeat), 6),
+        'parse_names': round(timed(names, repeat), 6),
+        'parse_slots': round(timed(slots, repeat), 6),
+        'bytes': retained,
+        'bytes_decoded': deep_size(parsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--fragments', type=int, default=4,
+                        help='slot ranges per master')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    data = reply(args.nodes, args.fragments)
+    fields = ('addr', 'flags', 'replicate', 'slots', 'migrating', 'importing')
+    old, new = [dict((n['name'], tuple(n[f] for f in fields)) for n in p(data))
+                for p in (dict_parser, parse_nodes)]
+    assert old == new
+
+    result = {
+        'nodes': args.nodes,
+        'fragments': args.fragments,
+        'reply_bytes': len(data),
+        'dict': bench(dict_parser, data, args.repeat),
+        'record': bench(parse_nodes, data, args.repeat),
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
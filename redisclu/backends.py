@@ -0,0 +1,73 @@
+"""
+Concurrency backends for cluster operations.
+
+`thread` runs every task on an OS thread. `gevent` runs tasks as greenlets
+on cooperative sockets, so hundreds of slot pipelines fit into a single
+thread. gevent is optional (pip install redis-clu[gevent]) and has to be
+selected before any connection is opened.
+"""
+import sys
+import concurrent.futures
+
+BACKENDS = ('thread', 'gevent')
+
+_backend = 'thread'
+
+
+def use(name):
+    global _backend
+    assert name in BACKENDS
+    if name == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    _backend = name
+
+
+def executor(max_workers):
+    if _backend == 'gevent':
+        return GeventExecutor(max_workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
+class GeventExecutor(object):
+    """
+    concurrent.futures style executor on top of a gevent pool.
+    """
+
+    def __init__(self, max_workers):
+        from gevent.pool import Pool
+        self.pool = Pool(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                if hasattr(future, 'set_exception_info'):
+                    future.set_exception_info(*sys.exc_info()[1:])
+                else:
+                    future.set_exception(sys.exc_info()[1])
+            else:
+                future.set_result(result)
+
+        self.pool.spawn(run)
+        return future
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (f.result() for f in futures)
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.pool.join()
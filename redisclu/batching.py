@@ -0,0 +1,51 @@
+class KeyBatch(object):
+    """
+    Number of keys fetched with GETKEYSINSLOT and moved with one MIGRATE.
+
+    The size adapts so that migrating one batch takes about `target`
+    seconds and carries at most `max_payload` bytes. A batch with
+    minimum == maximum keeps a fixed size.
+    """
+
+    def __init__(self, size=10, minimum=1, maximum=10000, target=0.25,
+                 max_payload=16 * 1024 * 1024, key_bytes=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.max_payload = max_payload
+        self.key_bytes = key_bytes
+        self.size = max(minimum, min(maximum, size))
+
+    @classmethod
+    def fixed(cls, size, key_bytes=None):
+        return cls(size, minimum=size, maximum=size, key_bytes=key_bytes)
+
+    @property
+    def adaptive(self):
+        return self.minimum != self.maximum
+
+    def update(self, keys, elapsed, payload=None):
+        """
+        Record that `keys` keys (`payload` bytes) were migrated in `elapsed`
+        seconds and pick the next batch size.
+        """
+        if not keys or not self.adaptive:
+            return
+
+        if elapsed > 0:
+            ideal = keys * self.target / elapsed
+        else:
+            ideal = self.size * 2
+
+        if payload is None and self.key_bytes:
+            payload = keys * self.key_bytes
+        if payload:
+            ideal = min(ideal, keys * self.max_payload / float(payload))
+
+        # grow at most twice, shrink at most four times per step
+        size = max(self.size // 4, min(ideal, self.size * 2))
+        self.size = int(max(self.minimum, min(self.maximum, size)))
+
+    def shrink(self):
+        if self.adaptive:
+            self.size = max(self.minimum, self.size // 4)
@@ -1,58 +1,121 @@
-import sys
-import time
-import redis
-import itertools
+import json
 import concurrent.futures
 
-from random import shuffle
-
+from redisclu import backends
+from redisclu import planner
 from redisclu.cli import helper as cli_helper
 from redisclu.cluster import Cluster
-from redisclu.node import Node, MockNode
-from redisclu.utils import echo
+from redisclu.heatmap import Heatmap
+from redisclu.journal import Journal
+from redisclu.monitor import Monitor
+from redisclu.node import Node
+from redisclu.status import ClusterStatus
+from redisclu.throttle import Throttle
+from redisclu.utils import (echo, fan_out)
+
+
+def migration_arguments(func):
+    arguments = [
+        (('--keyMigrationCount',), dict(default='auto')),
+        (('--keyMigrationMode',), dict(default='keys',
+                                       choices=['keys', 'single'])),
+        (('--sourceConcurrency',), dict(default=2)),
+        (('--destinationConcurrency',), dict(default=2)),
+        (('--slotWindow',), dict(default=1)),
+        (('--waitTimeout',), dict(default=10)),
+        (('--checkTimeout',), dict(default=2)),
+        (('--journal',), dict(default=None)),
+        (('--progress',), dict(default=0)),
+        (('--metricsFile',), dict(default=None)),
+        (('--metricsInterval',), dict(default=1)),
+        (('--maxKeysPerSec',), dict(default=0)),
+        (('--maxBytesPerSec',), dict(default=0)),
+        (('--maxLatency',), dict(default=0)),
+        (('--throttleFile',), dict(default=None)),
+        (('--bigKeyBytes',), dict(default=0)),
+        (('--bigKeyTimeout',), dict(default=120000)),
+        (('--retryBudget',), dict(default=5)),
+    ]
+    for args, kwargs in arguments:
+        func = cli_helper.argument(*args, **kwargs)(func)
+    return func
+
+
+def configure_migration(cluster, args):
+    count = args.keyMigrationCount
+    if count != 'auto':
+        count = int(count)
+    cluster.set_key_migration_count(count)
+    cluster.set_key_migration_mode(args.keyMigrationMode)
+    cluster.set_migration_concurrency(int(args.sourceConcurrency),
+                                      int(args.destinationConcurrency))
+    cluster.set_slot_window(int(args.slotWindow))
+    cluster.set_wait_timeout(float(args.waitTimeout))
+    cluster.set_check_timeout(float(args.checkTimeout))
+    if args.journal:
+        cluster.set_journal(Journal(args.journal))
+    cluster.set_reporting(path=args.metricsFile,
+                          progress=int(args.progress) == 1,
+                          interval=float(args.metricsInterval))
+    cluster.set_retry_budget(int(args.retryBudget))
+    cluster.set_big_keys(int(args.bigKeyBytes), int(args.bigKeyTimeout))
+    throttle = Throttle(keys=int(args.maxKeysPerSec),
+                        bytes=int(args.maxBytesPerSec),
+                        latency=float(args.maxLatency),
+                        control=args.throttleFile)
+    if throttle.enabled:
+        throttle.install_signals()
+        cluster.set_throttle(throttle)
 
 
 @cli_helper.command
 @cli_helper.argument('masters', nargs='+')
+@cli_helper.argument('--waitTimeout', default=60)
+@cli_helper.argument('--replicas', default=0)
 def create(args):
-    creator = cli_helper.ClusterCreator(args.masters)
+    replicas = int(args.replicas)
+    creator = cli_helper.ClusterCreator(args.masters, replicas)
     if not creator.check():
         echo('Pre-requirements to create cluster.\n', color='red')
-        echo('\t1. At least 2 redis instances must be provided.')
+        echo('\t1. At least {} redis instances must be provided.'.format(
+            2 * (replicas + 1)))
         echo('\t2. Should be set <cluster_enabled> on redis server conf.')
         echo('\t3. Should be removed all keys in db 0.')
         echo('\t4. Any redis instance should not be member of other cluster.')
         exit()
     creator.initialize_slots()
+    creator.cluster.set_wait_timeout(float(args.waitTimeout))
     creator.show_cluster_info()
     creator.bind_slots()
     creator.bind_config_epoch()
     creator.join_cluster()
     echo('Waiting for the cluster to join ', end='')
-    sys.stdout.flush()
-    time.sleep(1)
-    while not creator.cluster.consistent():
-        echo('.', end='')
-        sys.stdout.flush()
-        time.sleep(1)
+    creator.cluster.wait()
+    echo('OK', color='green')
+    if creator.slaves:
+        echo('Attaching slaves ', end='')
+        failures = creator.attach_slaves()
+        if failures:
+            echo('FAILED', color='red')
+            for slave, e in failures.items():
+                echo('\t{}:{} {}'.format(slave.host, slave.port, e))
+        else:
+            echo('OK', color='green')
 
 
 @cli_helper.command
 @cli_helper.argument('cluster')
+@cli_helper.argument('--checkTimeout', default=2)
+@cli_helper.argument('--json', default=0)
 def status(args):
-    cluster = Cluster.from_node(Node.from_uri(args.cluster))
-    dis = []
-    for n in cluster.masters:
-        slaves = ','.join([s['addr'] for s in n.slaves(n.name)])
-        msg = '{} {}:{} {} {}'.format(n.name, n.host, n.port, len(n.slots),
-                                      slaves)
-        dis.append(msg)
-    echo('\n'.join(dis))
-    echo('Masters:', len(cluster.masters))
-    echo('Slaves:', len(cluster.nodes) - len(cluster.masters))
-    covered_slots = sum(len(n.slots) for n in cluster.masters)
-    echo('Covered Slots:', covered_slots)
-    if covered_slots == cluster.CLUSTER_HASH_SLOTS:
+    status = ClusterStatus(Node.from_uri(args.cluster),
+                           timeout=float(args.checkTimeout)).collect()
+    if int(args.json) == 1:
+        echo(json.dumps(status.to_dict()))
+        return
+
+    status.show()
+    if status.healthy:
         echo('Cluster is healthy!')
     else:
         echo('!!!Cluster is not healthy!!!')
@@ -61,12 +124,47 @@ def status(args):
         echo('"redis-clu fix {}" would be great if there is exists cluster!'.format(args.cluster))
 
     echo('\n')
+    status.show_keyspace()
 
-    for master in cluster.masters:
-        echo(master)
-        echo('===========================')
-        echo(master.execute_command('info', 'keyspace'))
-        echo('\n')
+
+@cli_helper.command
+@cli_helper.argument('cluster')
+@cli_helper.argument('--interval', default=1)
+@cli_helper.argument('--count', default=0)
+@cli_helper.argument('--checkTimeout', default=2)
+@cli_helper.argument('--json', default=0)
+def monitor(args):
+    """
+    poll the cluster and print what changed since the previous sample
+    """
+    monitor = Monitor(Node.from_uri(args.cluster),
+                      interval=float(args.interval),
+                      timeout=float(args.checkTimeout))
+    try:
+        monitor.run(count=int(args.count), as_json=int(args.json) == 1)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli_helper.command
+@cli_helper.argument('cluster')
+@cli_helper.argument('--samples', default=5)
+@cli_helper.argument('--top', default=10)
+@cli_helper.argument('--cache', default=None)
+@cli_helper.argument('--ttl', default=60)
+@cli_helper.argument('--json', default=0)
+def heatmap(args):
+    """
+    key count and memory distribution per slot and per master
+    """
+    cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    collector = Heatmap(cluster, samples=int(args.samples),
+                        ttl=float(args.ttl), path=args.cache)
+    collector.collect()
+    if int(args.json) == 1:
+        echo(json.dumps(collector.to_dict()))
+    else:
+        collector.show(int(args.top))
 
 
 @cli_helper.command
@@ -86,18 +184,18 @@ def fix(args):
 @cli_helper.command
 @cli_helper.argument('cluster')
 @cli_helper.argument('master')
-@cli_helper.argument('--keyMigrationCount', default=1)
+@migration_arguments
 @cli_helper.pass_ctx
 def add(ctx, args):
     """
     add master node to cluster
     """
     cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    configure_migration(cluster, args)
     if not cluster.healthy():
         ctx.abort(
             'Cluster not healthy. Run "redis-clu fix {}" first'.format(
                 args.cluster))
-    cluster.set_key_migration_count(int(args.keyMigrationCount))
     cluster.add_node(args.master)
     cluster.reshard()
     cluster.wait()
@@ -107,115 +205,124 @@ def add(ctx, args):
 @cli_helper.command
 @cli_helper.argument('cluster')
 @cli_helper.argument('masters', nargs='+')
-@cli_helper.argument('--keyMigrationCount', default=1)
+@migration_arguments
 @cli_helper.pass_ctx
 def add_multi(ctx, args):
+    """
+    add master nodes to cluster, slots are moved to all of them concurrently
+    """
     cluster = Cluster.from_node(Node.from_uri(args.cluster))
-    if len(args.masters) > len(cluster.nodes):
-        ctx.abort('Length of new node list should be less than length of '
-                  'cluster master nodes.')
+    configure_migration(cluster, args)
     if not cluster.healthy():
         ctx.abort(
             'Cluster not healthy. Run "redis-clu fix {}" first'.format(
                 args.cluster))
-    masters = filter(lambda n: n.is_master(), cluster.nodes)
-    residual_count = len(masters) % len(args.masters)
-    if residual_count:
-        for i in range(len(args.masters) - residual_count):
-            masters.append(MockNode())
-
     for master in args.masters:
         cluster.add_node(master)
-
-    shard_ratio = len(masters) / len(args.masters)
-
-    shuffle(masters)
-
-    sub_clusters = []
-    while masters:
-        sub_nodes = masters[:shard_ratio]
-        new_master = args.masters.pop()
-        nodes = filter(lambda n: not isinstance(n, MockNode), sub_nodes)
-        nodes.append(Node.from_uri(new_master))
-        hash_slots = len(list(itertools.chain(
-            *[n.slots for n in nodes])))
-        sub_cluster = Cluster(nodes, hash_slots=hash_slots,
-                              parent_nodes=cluster.nodes)
-        sub_cluster.set_key_migration_count(int(args.keyMigrationCount))
-        sub_clusters.append(sub_cluster)
-        for sn in sub_nodes:
-            masters.pop(masters.index(sn))
-
-    future_to_args = dict()
-    executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers=len(sub_clusters))
-
-    for sub_cluster in sub_clusters:
-        args = ()
-        future = executor.submit(sub_cluster.reshard)
-        future_to_args.setdefault(future, args)
-
-    concurrent.futures.wait(future_to_args)
-    executor.shutdown(wait=False)
-    time.sleep(1)
+    cluster.reshard()
     cluster.wait()
-
-    for sub_cluster in sub_clusters:
-        sub_cluster.print_attempts()
+    cluster.print_attempts()
 
 
 @cli_helper.command
 @cli_helper.argument('cluster')
-@cli_helper.argument('--keyMigrationCount', default=1)
+@migration_arguments
 @cli_helper.pass_ctx
 def reshard(ctx, args):
     cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    configure_migration(cluster, args)
     if not cluster.healthy():
         ctx.abort(
             'Cluster not healthy. Run "redis-clu fix {}" first'.format(
                 args.cluster))
-    cluster.set_key_migration_count(int(args.keyMigrationCount))
     cluster.reshard()
     cluster.wait()
     cluster.print_attempts()
 
 
+@cli_helper.command
+@cli_helper.argument('cluster')
+@cli_helper.argument('--weight', default='bytes', choices=planner.WEIGHTS)
+@cli_helper.argument('--threshold', default=0.05)
+@cli_helper.argument('--samples', default=5)
+@cli_helper.argument('--heatmapCache', default=None)
+@cli_helper.argument('--heatmapTTL', default=60)
+@cli_helper.argument('--dryRun', default=0)
+@migration_arguments
+@cli_helper.pass_ctx
+def rebalance(ctx, args):
+    """
+    balance slots, keys or memory across masters moving the fewest bytes
+    """
+    cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    configure_migration(cluster, args)
+    if not cluster.healthy():
+        ctx.abort(
+            'Cluster not healthy. Run "redis-clu fix {}" first'.format(
+                args.cluster))
+    heatmap = Heatmap(cluster, samples=int(args.samples),
+                      ttl=float(args.heatmapTTL), path=args.heatmapCache)
+    plan = cluster.plan_rebalance(args.weight, float(args.threshold),
+                                  heatmap)
+    plan.show()
+    if int(args.dryRun) == 1:
+        return
+    cluster.execute_plan(plan)
+    cluster.wait()
+    cluster.print_attempts()
+
+
 @cli_helper.command
 @cli_helper.argument('cluster')
 @cli_helper.argument('node')
-@cli_helper.argument('--keyMigrationCount', default=1)
+@migration_arguments
 @cli_helper.pass_ctx
 def remove(ctx, args):
     '''
     remove node from cluster
     '''
     cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    configure_migration(cluster, args)
     if not cluster.healthy():
         ctx.abort(
             'Cluster not healthy. Run "redis-clu fix {}" first'.format(
                 args.cluster))
-    cluster.set_key_migration_count(int(args.keyMigrationCount))
     cluster.remove_node(Node.from_uri(args.node))
     cluster.wait()
     cluster.print_attempts()
 
 
+@cli_helper.command
+@cli_helper.argument('cluster')
+@migration_arguments
+@cli_helper.pass_ctx
+def resume(ctx, args):
+    """
+    run slot moves left over in the journal of an interrupted command
+    """
+    if not args.journal:
+        ctx.abort('--journal is required.')
+    cluster = Cluster.from_node(Node.from_uri(args.cluster))
+    configure_migration(cluster, args)
+    cluster.resume()
+    cluster.wait()
+    cluster.print_attempts()
+
+
 @cli_helper.command
 @cli_helper.argument('master')
-@cli_helper.argument('slave')
+@cli_helper.argument('slaves', nargs='+')
 @cli_helper.pass_ctx
 def replicate(ctx, args):
     master = Node.from_uri(args.master)
     if not master.is_master():
         ctx.abort('Node {} is not a master.'.format(args.master))
     cluster = Cluster.from_node(master)
-    cluster.add_node(args.slave)
-    slave = Node.from_uri(args.slave)
-    try:
-        slave.replicate(master.name)
-    except redis.ResponseError as e:
-        ctx.abort(str(e))
-    cluster.wait()
+    slaves = fan_out(Node.from_uri, args.slaves)
+    failures = cluster.replicate({master: slaves})
+    if failures:
+        ctx.abort('\n'.join('{}:{} {}'.format(s.host, s.port, e)
+                             for s, e in failures.items()))
 
 
 @cli_helper.command
@@ -224,8 +331,7 @@ def replicate(ctx, args):
 def reset(args):
     cluster = Cluster.from_node(Node.from_uri(args.cluster))
     future_to_args = dict()
-    executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers=len(cluster.masters))
+    executor = backends.executor(len(cluster.masters))
 
     for master in cluster.masters:
         f_args = ()
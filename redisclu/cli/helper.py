@@ -1,8 +1,9 @@
 import argparse
 import collections
+from redisclu import backends
 from redisclu.node import Node
 from redisclu.cluster import Cluster
-from redisclu.utils import echo, spread, divide
+from redisclu.utils import echo, spread, divide, fan_out, place_replicas
 
 
 class Context(object):
@@ -64,6 +65,8 @@ class Command(object):
 class CommandParser(object):
     def __init__(self, *args, **kwargs):
         self.parser = argparse.ArgumentParser(*args, **kwargs)
+        self.parser.add_argument('--backend', default='thread',
+                                 choices=backends.BACKENDS)
         self.subparser = self.parser.add_subparsers(title='Subcommands')
 
     def add_command(self, command):
@@ -75,6 +78,7 @@ class CommandParser(object):
 
     def run(self):
         args = self.parser.parse_args()
+        backends.use(args.backend)
         args.func(args)
 
 
@@ -93,45 +97,57 @@ class MasterCandidate(object):
 
     def bind_slots(self):
         assert self.unbinded_slots
-        for chunk in self.unbinded_slots:
-            self.add_slots(*range(*chunk))
+        self.add_slots_range(*[(start, end - 1)
+                               for start, end in self.unbinded_slots])
 
     def is_enabled(self):
         return self.unbinded_slots
 
 
 class ClusterCreator(object):
-    def __init__(self, masters):
-        master_candidates = [Node.from_uri(i) for i in masters]
+    def __init__(self, masters, replicas=0):
+        master_candidates = fan_out(Node.from_uri, masters)
         self.master_candidates = [MasterCandidate(i) for i in
                                   master_candidates]
+        self.replicas = replicas
         self.masters = []
+        self.slaves = {}
+        self.unplaced = 0
         self.cluster = None
 
     def check(self):
         # check pre-requirements
-        if len(self.master_candidates) < 2:
+        if len(self.master_candidates) < 2 * (self.replicas + 1):
+            return False
+        return all(fan_out(self.check_candidate, self.master_candidates))
+
+    @staticmethod
+    def check_candidate(master):
+        if not master.info().get('cluster_enabled'):
+            return False
+        master.execute_command('select', '0')
+        if master.randomkey():
+            return False
+        if master.cluster_info()['cluster_known_nodes'] != 1:
             return False
-        for master in self.master_candidates:
-            if not master.info().get('cluster_enabled'):
-                return False
-            master.execute_command('select', '0')
-            if master.randomkey():
-                return False
-            if master.cluster_info()['cluster_known_nodes'] != 1:
-                return False
         return True
 
     def initialize_slots(self):
         ips = collections.defaultdict(list)
         for candidate in self.master_candidates:
             ips[candidate.host].append(candidate)
-        master_count = len(self.master_candidates)
+        master_count = len(self.master_candidates) // (self.replicas + 1)
         self.masters = masters = spread(ips, master_count)
         chunks = self.split_slot(Cluster.CLUSTER_HASH_SLOTS, master_count)
         for master, chunk in zip(masters, chunks):
             master.unbinded_slots.append(chunk)
 
+        spare = [i.master for i in self.master_candidates
+                 if not i.is_enabled()]
+        placement, self.unplaced = place_replicas(
+            [m.master for m in masters], spare, self.replicas)
+        self.slaves = dict((m, placement[m.master]) for m in masters)
+
         self.master_candidates = [i for i in self.master_candidates if
                                   i.is_enabled()]
         self.cluster = Cluster(self.master_candidates)
@@ -145,27 +161,48 @@ class ClusterCreator(object):
             slot_msg = ','.join(['-'.join([str(s[0]), str(s[1] - 1)])
                                  for s in instance.unbinded_slots])
             echo('\tslots:', slot_msg)
+            for slave in self.slaves.get(instance, []):
+                echo('S', end='', color='yellow')
+                echo(name_msg.format(name=slave.name, host=slave.host,
+                                     port=slave.port))
+        if self.unplaced:
+            echo('{} replica(s) could not be placed on a host other than '
+                 'their master'.format(self.unplaced), color='yellow')
 
     def bind_slots(self):
-        for master in self.masters:
-            master.bind_slots()
+        fan_out(lambda master: master.bind_slots(), self.masters)
 
     def join_cluster(self):
-        if not self.masters:
+        """
+        Every master MEETs the next half of the ring in one pipeline, so
+        each pair shakes hands directly instead of waiting for gossip
+        to spread through a single seed.
+        """
+        masters = self.masters
+        if len(masters) < 2:
             return
 
-        first_master = self.masters[0]
-        for master in self.masters[1:]:
-            master.meet(first_master.host, first_master.port)
+        def meet(i):
+            peers = [masters[(i + d) % len(masters)]
+                     for d in range(1, len(masters) // 2 + 1)]
+            return masters[i].meet_many([(p.host, p.port) for p in peers])
+
+        fan_out(meet, range(len(masters)))
+
+    def attach_slaves(self):
+        placement = dict((m.master, slaves)
+                         for m, slaves in self.slaves.items())
+        return self.cluster.replicate(placement)
 
     def bind_config_epoch(self):
-        epoch = 1
-        for instance in self.masters:
+        def bind(args):
+            epoch, instance = args
             try:
                 instance.set_config_epoch(epoch)
             except:
                 pass
-            epoch += 1
+
+        fan_out(bind, enumerate(self.masters, 1))
 
     def split_slot(self, n, m):
         chunks = divide(n, m)
@@ -1,11 +1,22 @@
 import time
 import itertools
 import hashlib
+import threading
+import collections
+import concurrent.futures
+import backends
 import failover
+import planner
 
 from node import Node
-from exceptions import (ClusterNotHealthy, ClusterNotConsistent)
-from utils import (divide, echo)
+from batching import KeyBatch
+from heatmap import Heatmap
+from metrics import (MigrationMetrics, Reporter)
+from slots import SlotRanges
+from topology import Topology
+from exceptions import (ClusterNotHealthy, ClusterNotConsistent,
+                        MigrationRetry)
+from utils import (divide, echo, fan_out, gather)
 
 
 class Cluster(object):
@@ -17,7 +28,21 @@ class Cluster(object):
         self.parent_nodes = parent_nodes if parent_nodes else nodes
         self.CLUSTER_HASH_SLOTS = hash_slots
         self.attempts = []
-        self.key_migration_count = 1
+        self.key_migration_count = 'auto'
+        self.key_migration_mode = 'keys'
+        self.migration_concurrency = (2, 2)
+        self.slot_window = 1
+        self.wait_timeout = 10
+        self.check_timeout = 2
+        self.unreachable = {}
+        self.broadcast = SlotMappingBroadcast()
+        self.journal = None
+        self.throttle = None
+        self.retry_policy = failover.RetryPolicy()
+        self.big_key_bytes = 0
+        self.big_key_timeout = 120000
+        self.metrics = MigrationMetrics()
+        self.reporter = Reporter(self.metrics)
 
     @classmethod
     def from_node(cls, node):
@@ -32,34 +57,147 @@ class Cluster(object):
     def set_key_migration_count(self, val):
         self.key_migration_count = val
 
+    def key_batch(self, node):
+        """
+        Batch of keys migrated at once from node, adaptive per source node
+        unless a fixed key migration count is set.
+        """
+        count = self.key_migration_count
+        fixed = count != 'auto'
+        batch = node.key_batch
+        if batch is None or batch.adaptive == fixed or \
+                (fixed and batch.size != count):
+            # fixed batches need the key size too, for metrics and throttle
+            key_bytes = node.average_key_size()
+            if fixed:
+                batch = KeyBatch.fixed(count, key_bytes=key_bytes)
+            else:
+                batch = KeyBatch(key_bytes=key_bytes)
+            node.key_batch = batch
+        return batch
+
+    def set_key_migration_mode(self, val):
+        self.key_migration_mode = val
+
+    def set_migration_concurrency(self, per_source, per_destination):
+        self.migration_concurrency = (per_source, per_destination)
+
+    def set_slot_window(self, val):
+        self.slot_window = val
+
+    def set_big_keys(self, threshold, timeout):
+        self.big_key_bytes = threshold
+        self.big_key_timeout = timeout
+
+    def set_retry_budget(self, val):
+        self.retry_policy = failover.RetryPolicy(budget=val)
+
+    def set_throttle(self, throttle):
+        self.throttle = throttle
+
+    def set_journal(self, journal):
+        self.journal = journal
+
+    def set_reporting(self, path=None, progress=False, interval=1):
+        self.reporter = Reporter(self.metrics, path=path, progress=progress,
+                                 interval=interval)
+
+    def set_wait_timeout(self, val):
+        self.wait_timeout = val
+
+    def set_check_timeout(self, val):
+        self.check_timeout = val
+
+    def scheduler(self):
+        per_source, per_destination = self.migration_concurrency
+        return MigrationScheduler(self, per_source=per_source,
+                                  per_destination=per_destination)
+
+    def _report_unreachable(self, failures):
+        for node, exc in failures.items():
+            if node not in self.unreachable:
+                echo('{} did not answer: {}'.format(node, exc), color='red')
+        self.unreachable = failures
+
+    def views(self):
+        """
+        CLUSTER NODES of every master, fetched from all nodes concurrently.
+        Nodes which do not answer within `check_timeout` are reported and
+        kept in `unreachable` instead of stalling the check.
+        """
+        views, failures = gather(lambda n: n.nodes(), self.nodes,
+                                 timeout=self.check_timeout)
+        self._report_unreachable(failures)
+        return [view for node, view in views.items() if node.is_master()]
+
+    def signature(self, view):
+        ranges, names = [], []
+        for node in view:
+            ranges.extend(node['slots'].ranges)
+            names.append(node['name'])
+        info = '{}:{}'.format('|'.join(sorted(names)),
+                              ','.join('{}-{}'.format(*r)
+                                       for r in sorted(ranges)))
+        return hashlib.md5(info).hexdigest()
+
     def consistent(self):
-        sig = set()
-        for instance in self.nodes:
-            if not instance.is_master():
-                continue
-            nodes = instance.nodes()
-            slots, names = [], []
-            for node in nodes:
-                slots.extend(node['slots'])
-                names.append(node['name'])
-            info = '{}:{}'.format('|'.join(sorted(names)),
-                                  ','.join(str(i) for i in sorted(slots)))
-            sig.add(hashlib.md5(info).hexdigest())
-        return len(sig) == 1
+        return len(set(self.signature(v) for v in self.views())) == 1
+
+    def converged(self):
+        """
+        Cheap convergence check, compares CLUSTER INFO of all nodes.
+        """
+        # roles come from the same concurrent round, a per node is_master()
+        # would refresh the invalidated topologies one after another
+        replies, failures = gather(lambda n: (n.nodes()[0], n.cluster_info()),
+                                   self.nodes, timeout=self.check_timeout)
+        self._report_unreachable(failures)
+        infos = [info for myself, info in replies.values()]
+        for field in ('cluster_current_epoch', 'cluster_slots_assigned',
+                      'cluster_known_nodes'):
+            if len(set(i[field] for i in infos)) != 1:
+                return False
+
+        # config epochs of masters serving slots must be unique
+        epochs = [i['cluster_my_epoch'] for myself, i in replies.values()
+                  if 'master' in myself.flags and i['cluster_my_epoch']]
+        return len(epochs) == len(set(epochs))
+
+    def covered_slots(self):
+        """
+        Slots covered according to the masters which answered, None if
+        none answered or they disagree. Unreachable nodes are reported on
+        their own and do not fail the check.
+        """
+        views = self.views()
+        if not views or len(set(self.signature(v) for v in views)) != 1:
+            return None
+        return sum(len(n['slots']) for n in views[0])
 
     def healthy(self):
-        slots = list(itertools.chain(*[i.slots for i in self.nodes]))
-        return len(slots) == self.CLUSTER_HASH_SLOTS and self.consistent()
-
-    def wait(self):
-        check = 0
-        while not self.consistent():
-            time.sleep(1)
-            if check == 10:
+        return self.covered_slots() == self.CLUSTER_HASH_SLOTS
+
+    def wait(self, timeout=None):
+        self.flush_slot_mapping()
+        if timeout is None:
+            timeout = self.wait_timeout
+        deadline = time.time() + timeout
+        delay = 0.05
+        # full topology comparison only once CLUSTER INFO agrees
+        while not (self.converged() and self.consistent()):
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 raise ClusterNotConsistent('Error: cluster is not consistent')
-            check += 1
-
-        if not self.healthy():
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1)
+
+        slots = self.covered_slots()
+        if slots is None and self.unreachable:
+            raise ClusterNotHealthy('Error: {} node(s) did not answer'.format(
+                len(self.unreachable)))
+        if slots is None:
+            raise ClusterNotConsistent('Error: cluster is not consistent')
+        if slots != self.CLUSTER_HASH_SLOTS:
             raise ClusterNotHealthy('Error: missing slots')
 
     def get_node(self, node_id):
@@ -95,6 +233,10 @@ class Cluster(object):
         if not self.consistent():
             return
 
+        if self.journal and self.journal.pending():
+            self.resume()
+            return
+
         nodes = [{
                      "node": n,
                      "count": len(n.slots),
@@ -103,11 +245,13 @@ class Cluster(object):
 
         nodes = self.slot_balance(nodes)
 
+        scheduler = self.scheduler()
         for n in nodes:
             if not n["need"]:
                 continue
             for src, count in n["need"]:
-                self.migrate(src, n["node"], count)
+                scheduler.add(src, n["node"], count)
+        scheduler.run()
 
     @failover.on_timeout
     def remove_node(self, node):
@@ -136,34 +280,54 @@ class Cluster(object):
         self.nodes.append(new)
         self.wait()
 
+    def replicate(self, placement):
+        """
+        placement: {master: [slave]}, slaves MEET their masters and start
+        replicating concurrently.
+
+        Returns {slave: exception} of failed CLUSTER REPLICATE calls.
+        """
+        pairs = [(m, s) for m, slaves in placement.items() for s in slaves]
+        if not pairs:
+            return {}
+        fan_out(lambda p: p[1].meet(p[0].host, p[0].port), pairs)
+        self.nodes.extend(s for _, s in pairs if s not in self.nodes)
+        self.wait()
+
+        _, failures = gather(lambda p: p[1].replicate(p[0].name), pairs)
+        self.wait()
+        return dict((s, e) for (_, s), e in failures.items())
+
+    def missing_slots(self, masters):
+        covered = SlotRanges().union(*[n.slots for n in masters])
+        return SlotRanges.full(self.CLUSTER_HASH_SLOTS).difference(covered)
+
     def fill_slots(self):
         masters = self.masters
-        slots = itertools.chain(*[n.slots for n in masters])
-        missing = list(set(range(self.CLUSTER_HASH_SLOTS)).difference(slots))
+        missing = self.missing_slots(masters)
 
         div = divide(len(missing), len(masters))
         masters.sort(key=lambda x: len(x.slots))
 
-        i = 0
-        for count, node in zip(div, masters):
-            node.add_slots(*missing[i:count + i])
-            i += count
+        for chunk, node in zip(missing.split(div), masters):
+            node.add_slots(*chunk)
 
     def bind_slots_force(self):
         masters = self.masters
-        slots = itertools.chain(*[n.slots for n in masters])
-        missing = list(set(range(self.CLUSTER_HASH_SLOTS)).difference(slots))
+        missing = self.missing_slots(masters)
 
         div = divide(len(missing), len(masters))
         masters.sort(key=lambda x: len(x.slots))
 
-        i = 0
-        for count, node in zip(div, masters):
-            for slot in missing[i:count + i]:
+        for chunk, node in zip(missing.split(div), masters):
+            for slot in chunk:
                 self.update_slot_mapping(slot, node.name)
-            i += count
+        self.flush_slot_mapping()
 
     def migrate_node(self, src_node):
+        if self.journal and self.journal.pending():
+            self.resume()
+
         nodes = [n for n in self.masters if n.name != src_node.name]
         slot_count = len(src_node.slots)
         if slot_count <= 0:
@@ -172,35 +336,111 @@ class Cluster(object):
 
         nodes.sort(key=lambda x: len(x.slots))
 
+        scheduler = self.scheduler()
         for node, count in zip(nodes, slots):
-            src, dst = (src_node, node)
-            self.migrate(src, dst, count)
+            scheduler.add(src_node, node, count)
+        scheduler.run()
 
-    def migrate(self, src, dst, count):
-        if count <= 0:
+    def resume(self):
+        """
+        Run slot moves planned in the journal which are not completed yet.
+        """
+        scheduler = self.scheduler()
+        for record in self.journal.pending():
+            slot = record['slot']
+            src, dst = self.get_node(record['src']), self.get_node(record['dst'])
+            if src is None or dst is None:
+                echo('Skipping slot {}, {} -> {} is not in cluster'.format(
+                    slot, record['src_addr'], record['dst_addr']),
+                    color='yellow')
+                continue
+            if slot in dst.slots:
+                self.journal.complete(src, dst, slot)
+                continue
+            scheduler.schedule(src, dst, [slot])
+        scheduler.run()
+
+    def slot_stats(self, node, samples=5, refresh=False):
+        """
+        {slot: (keys, bytes)} of node, bytes are estimated from `samples`
+        keys per slot or from the average key size if samples is 0. Cached
+        key counts are queried again if `refresh` is set.
+        """
+        counts = node.count_keys_in_slots(node.slots, refresh)
+        used = [s for s, c in counts.items() if c]
+        if samples:
+            usage = node.sample_memory_usage(used, samples)
+        else:
+            usage = dict.fromkeys(used, node.average_key_size() or 0)
+        return dict((s, (c, c * usage.get(s, 0))) for s, c in counts.items())
+
+    def plan_rebalance(self, weight='bytes', threshold=0.05, heatmap=None):
+        if heatmap is None:
+            heatmap = Heatmap(self)
+        return planner.plan(heatmap.collect(), weight, threshold)
+
+    @failover.on_timeout
+    def execute_plan(self, plan):
+        if self.journal and self.journal.pending():
+            self.resume()
             return
 
-        slots = src.slots
-        slots_count = len(slots)
-        if count > slots_count:
-            count = slots_count
+        scheduler = self.scheduler()
+        for move in plan.moves:
+            # already moved by an earlier attempt
+            if move.slot not in move.src.slots:
+                continue
+            scheduler.schedule(move.src, move.dst, [move.slot])
+        scheduler.run()
 
-        keys = [(s, src.count_keys_in_slot(s)) for s in slots]
-        keys.sort(key=lambda x: x[1])
+    def migrate(self, src, dst, count):
+        scheduler = self.scheduler()
+        scheduler.add(src, dst, count)
+        scheduler.run()
 
-        for slot, _ in keys[:count]:
-            src.migrate_slot(dst, slot, self)
+    def slots_by_key_count(self, node):
+        slots = node.slots
+        counts = node.count_keys_in_slots(slots)
+        return sorted(slots, key=counts.get)
 
-    def update_slot_mapping(self, slot, dst_name):
-        for node in self.parent_nodes:
-            node.set_slot('NODE', slot, dst_name)
+    def update_slot_mapping(self, slot, dst_name, src_name=None):
+        self.update_slots_mapping([slot], dst_name, src_name)
+
+    def update_slots_mapping(self, slots, dst_name, src_name=None):
+        """
+        Destination and source must acknowledge the new owner, the other
+        nodes are notified in background.
+        """
+        owners = [dst_name, src_name] if src_name else [dst_name]
+        for name in owners:
+            for node in self.parent_nodes:
+                if node.name == name:
+                    node.set_slots('NODE', slots, dst_name)
+
+        others = [n for n in self.parent_nodes if n.name not in owners]
+        for slot in slots:
+            self.broadcast.notify(others, slot, dst_name)
+
+    def flush_slot_mapping(self):
+        for node, exc in self.broadcast.flush():
+            self.attempts.append(exc)
+            echo('Slot mapping could not be sent to {}: {}'.format(node, exc),
+                 color='yellow')
 
     def print_attempts(self):
         for node in self.nodes:
             self.attempts.extend(node.attempts)
         echo('Length of attempts: {}'.format(len(self.attempts)))
-        for exc, group in itertools.groupby(self.attempts,
-                                            lambda a: type(a).__name__):
+        echo('CLUSTER NODES round trips: {}'.format(Topology.round_trips))
+        if self.throttle:
+            echo('Throttled for {:.1f}s'.format(self.throttle.paused))
+        retries = [a for a in self.attempts if isinstance(a, MigrationRetry)]
+        if retries:
+            echo('Retries: {}, waited {:.1f}s'.format(
+                len(retries), sum(r.delay for r in retries)), color='yellow')
+        name = lambda a: type(a).__name__
+        for exc, group in itertools.groupby(sorted(self.attempts, key=name),
+                                            name):
             length = len(list(group))
             echo(
                 'Exception: {}, Count: {}'.format(exc, length),
@@ -244,3 +484,168 @@ class Cluster(object):
                 i += 1
 
         return seq
+
+
+class MigrationScheduler(object):
+    """
+    Run independent slot moves at the same time.
+
+    At most `per_source` workers move slots out of a node and
+    `per_destination` workers move slots into a node concurrently, each
+    worker keeps up to `cluster.slot_window` slots open at once.
+    """
+
+    def __init__(self, cluster, per_source=1, per_destination=1):
+        assert per_source > 0 and per_destination > 0
+        self.cluster = cluster
+        self.per_source = per_source
+        self.per_destination = per_destination
+        self.queues = collections.OrderedDict()
+        self.candidates = {}
+
+    def add(self, src, dst, count):
+        """
+        Plan to move `count` slots with the fewest keys from src to dst.
+        """
+        if count <= 0:
+            return
+
+        if src.name not in self.candidates:
+            self.candidates[src.name] = self.cluster.slots_by_key_count(src)
+        candidates = self.candidates[src.name]
+        slots, candidates[:count] = candidates[:count], []
+        self.schedule(src, dst, slots)
+
+    def schedule(self, src, dst, slots):
+        queue = self.queues.setdefault((src, dst), collections.deque())
+        queue.extend(slots)
+
+    def run(self):
+        queues = collections.OrderedDict(
+            (pair, queue) for pair, queue in self.queues.items() if queue)
+        self.queues = collections.OrderedDict()
+        if not queues:
+            return
+
+        journal = self.cluster.journal
+        if journal:
+            journal.plan([(src, dst, slot) for (src, dst), queue in
+                          queues.items() for slot in queue])
+        metrics = self.cluster.metrics
+        for (src, dst), queue in queues.items():
+            metrics.plan(src, dst, queue)
+
+        sources = set(src.name for src, _ in queues)
+        destinations = set(dst.name for _, dst in queues)
+        max_workers = min(len(sources) * self.per_source,
+                          len(destinations) * self.per_destination)
+
+        self.cluster.reporter.start()
+        try:
+            self._run(queues, max_workers)
+        finally:
+            self.cluster.reporter.stop()
+
+        self.cluster.flush_slot_mapping()
+
+    def _run(self, queues, max_workers):
+        journal = self.cluster.journal
+        metrics = self.cluster.metrics
+        busy_sources = collections.Counter()
+        busy_destinations = collections.Counter()
+        running = {}
+        with backends.executor(max_workers) as executor:
+            while queues or running:
+                for pair in list(queues):
+                    src, dst = pair
+                    queue = queues[pair]
+                    while (queue and
+                           busy_sources[src.name] < self.per_source and
+                           busy_destinations[dst.name] < self.per_destination):
+                        slots = [queue.popleft() for _ in range(
+                            min(self.cluster.slot_window, len(queue)))]
+                        busy_sources[src.name] += 1
+                        busy_destinations[dst.name] += 1
+                        future = executor.submit(src.migrate_slots, dst,
+                                                 slots, self.cluster)
+                        running[future] = (src, dst, slots)
+                    if not queue:
+                        queues.pop(pair)
+
+                # a short timeout lets the main thread run signal handlers
+                # (throttle adjustments) while slots are in flight
+                done, _ = concurrent.futures.wait(
+                    running, timeout=0.5,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    src, dst, slots = running.pop(future)
+                    busy_sources[src.name] -= 1
+                    busy_destinations[dst.name] -= 1
+                    future.result()
+                    for slot in slots:
+                        metrics.record_slot(src, dst)
+                        if journal:
+                            journal.complete(src, dst, slot)
+
+
+class SlotMappingBroadcast(object):
+    """
+    Send CLUSTER SETSLOT <slot> NODE <id> to nodes in background.
+
+    Updates queued for a node are sent in a single pipeline, failures are
+    collected and returned by `flush` instead of aborting the migration.
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.futures = []
+        self.executor = None
+
+    def notify(self, nodes, slot, node_id):
+        idle = []
+        with self.lock:
+            if self.executor is None:
+                self.executor = backends.executor(self.max_workers)
+            executor = self.executor
+            for node in nodes:
+                updates = self.pending.get(node)
+                if updates is None:
+                    self.pending[node] = updates = []
+                    idle.append(node)
+                updates.append((slot, node_id))
+
+        # submit blocks on a full gevent pool while its workers wait for
+        # the lock in _send, so it must not be held here
+        futures = [executor.submit(self._send, node) for node in idle]
+        with self.lock:
+            self.futures.extend(futures)
+
+    def _send(self, node):
+        with self.lock:
+            updates = self.pending.pop(node)
+
+        try:
+            pipeline = node.redis.pipeline(transaction=False)
+            for slot, node_id in updates:
+                pipeline.execute_command('CLUSTER SETSLOT', slot, 'NODE',
+                                         node_id)
+            results = pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            return [(node, e)]
+        finally:
+            Topology.invalidate_all()
+        return [(node, r) for r in results if isinstance(r, Exception)]
+
+    def flush(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+            executor, self.executor = self.executor, None
+
+        errors = []
+        for future in futures:
+            errors.extend(future.result())
+        if executor is not None:
+            executor.shutdown()
+        return errors
@@ -41,4 +41,17 @@ class ClusterNotHealthy(RedisCluException):
 
 
 class ClusterNotConsistent(RedisCluException):
-    pass
\ No newline at end of file
+    pass
+
+
+class MigrationRetry(RedisCluException):
+    """
+    a timed out migration batch was retried, kept in attempts
+    """
+
+    def __init__(self, slots, attempt, delay):
+        self.args = ('slots {} retry {} after {:.2f}s'.format(
+            slots, attempt, delay),)
+        self.slots = slots
+        self.attempt = attempt
+        self.delay = delay
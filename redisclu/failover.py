@@ -1,20 +1,72 @@
 import time
+import random
+import threading
+import collections
 from redis.exceptions import TimeoutError
 
+from exceptions import MigrationRetry
 from utils import echo
 
 
+def jitter(attempt, base, cap):
+    # full jitter exponential backoff
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryPolicy(object):
+    """
+    Retry a timed out migration batch after a jittered exponential backoff,
+    at most `budget` times per slot.
+    """
+
+    def __init__(self, budget=5, base=0.1, cap=10):
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self.lock = threading.Lock()
+        self.retries = collections.Counter()
+
+    def reset(self):
+        with self.lock:
+            self.retries.clear()
+
+    def backoff(self, node, slots, error):
+        """
+        Record that moving slots out of node timed out and sleep before
+        the retry, re-raises error once a slot is out of budget.
+        """
+        with self.lock:
+            for slot in slots:
+                self.retries[slot] += 1
+            attempt = max(self.retries[slot] for slot in slots)
+        if attempt > self.budget:
+            raise error
+
+        delay = jitter(attempt - 1, self.base, self.cap)
+        node.attempts.append(error)
+        node.attempts.append(MigrationRetry(slots, attempt, delay))
+        echo('Timeout moving {} slot(s) out of {}, retry {}/{} in {:.2f}s'
+             .format(len(slots), node, attempt, self.budget, delay),
+             color='red')
+        time.sleep(delay)
+
+
 def on_timeout(f):
+    """
+    Last resort once a slot ran out of retries, run f again.
+    """
     def wrapper(*args, **kwargs):
-        for _ in range(100):
+        for attempt in range(100):
             try:
                 return f(*args, **kwargs)
             except TimeoutError as e:
                 args[0].attempts.append(e)
+                args[0].retry_policy.reset()
+                delay = jitter(attempt, 1, 10)
                 echo('Timeout error reading from socket. '
-                     'Trying again in 10 seconds.',
+                     'Trying again in {:.1f} seconds.'.format(delay),
                      color='red')
-                time.sleep(10)
+                time.sleep(delay)
         raise
 
     return wrapper
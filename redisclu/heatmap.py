@@ -0,0 +1,152 @@
+import os
+import json
+import time
+
+from utils import (echo, fan_out)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Heatmap(object):
+    """
+    Per-slot key counts and memory estimates of all masters.
+
+    Masters are swept concurrently, each with pipelined COUNTKEYSINSLOT and
+    sampled MEMORY USAGE. Results are reused for `ttl` seconds, optionally
+    across runs through a JSON cache file.
+    """
+
+    def __init__(self, cluster, samples=5, ttl=60, path=None):
+        self.cluster = cluster
+        self.samples = samples
+        self.ttl = ttl
+        self.path = path
+        self.stats = None
+        self.collected_at = None
+
+    @property
+    def fresh(self):
+        return (self.stats is not None and
+                time.time() - self.collected_at < self.ttl)
+
+    def collect(self, force=False):
+        """
+        {node: {slot: (keys, bytes)}} of every master.
+        """
+        if not force and not self.fresh:
+            self._load()
+        if force or not self.fresh:
+            masters = self.cluster.masters
+            # counts cached on the nodes are as old as the last sweep
+            stats = fan_out(
+                lambda n: self.cluster.slot_stats(n, self.samples,
+                                                  refresh=True), masters)
+            self.stats = dict(zip(masters, stats))
+            self.collected_at = time.time()
+            self._save()
+        return self.stats
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                return
+        if time.time() - data['collected_at'] >= self.ttl:
+            return
+
+        stats = {}
+        for name, slots in data['nodes'].items():
+            node = self.cluster.get_node(name)
+            if node is None:
+                return
+            slots = dict((int(s), tuple(v)) for s, v in slots.items())
+            # slots moved since the sweep, the cache is outdated
+            if len(slots) != len(node.slots) or \
+                    any(s not in node.slots for s in slots):
+                return
+            stats[node] = slots
+        self.stats = stats
+        self.collected_at = data['collected_at']
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {
+            'collected_at': self.collected_at,
+            'nodes': dict((node.name, slots)
+                          for node, slots in self.stats.items()),
+        }
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def nodes(self):
+        summary = []
+        total_bytes = sum(b for slots in self.stats.values()
+                          for _, b in slots.values()) or 1
+        for node, slots in self.stats.items():
+            keys = [k for k, _ in slots.values()]
+            size = sum(b for _, b in slots.values())
+            summary.append({
+                'node': node,
+                'slots': len(slots),
+                'keys': sum(keys),
+                'bytes': size,
+                'share': round(100.0 * size / total_bytes, 2),
+                'keys_per_slot': {
+                    'min': min(keys) if keys else 0,
+                    'p50': percentile(keys, 0.5),
+                    'p99': percentile(keys, 0.99),
+                    'max': max(keys) if keys else 0,
+                },
+            })
+        summary.sort(key=lambda x: x['bytes'], reverse=True)
+        return summary
+
+    def slots(self):
+        """
+        [(slot, node, keys, bytes)] sorted by slot.
+        """
+        return sorted((slot, node, keys, size)
+                      for node, slots in self.stats.items()
+                      for slot, (keys, size) in slots.items())
+
+    def hottest(self, top=10, by='bytes'):
+        index = 3 if by == 'bytes' else 2
+        return sorted(self.slots(), key=lambda x: x[index],
+                      reverse=True)[:top]
+
+    def to_dict(self):
+        nodes = []
+        for summary in self.nodes():
+            summary = dict(summary)
+            node = summary.pop('node')
+            summary.update(name=node.name,
+                           addr='{}:{}'.format(node.host, node.port))
+            nodes.append(summary)
+        return {
+            'collected_at': self.collected_at,
+            'nodes': nodes,
+            'slots': [{'slot': slot, 'node': owner.name, 'keys': keys,
+                       'bytes': size}
+                      for slot, owner, keys, size in self.slots()],
+        }
+
+    def show(self, top=10):
+        for s in self.nodes():
+            echo('{node} slots: {slots} keys: {keys} bytes: {bytes} '
+                 '({share}%)'.format(**s))
+            echo('\tkeys per slot min: {min} p50: {p50} p99: {p99} '
+                 'max: {max}'.format(**s['keys_per_slot']))
+        for by in ('bytes', 'keys'):
+            echo('Top {} slots by {}:'.format(top, by), color='yellow')
+            for slot, node, keys, size in self.hottest(top, by):
+                echo('\t{} {} keys: {} bytes: {}'.format(slot, node, keys,
+                                                         size))
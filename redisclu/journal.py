@@ -0,0 +1,85 @@
+import os
+import json
+import threading
+import collections
+
+
+class Journal(object):
+    """
+    Append-only JSON lines log of planned and completed slot moves.
+
+    {"event": "planned", "slot": 1, "src": <id>, "src_addr": "host:port",
+     "dst": <id>, "dst_addr": "host:port"}
+    {"event": "completed", "slot": 1, "src": <id>, "dst": <id>}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.planned = collections.OrderedDict()
+        self.completed = set()
+        self.lock = threading.Lock()
+        self.file = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be torn by a crash
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        slot = record['slot']
+        if record['event'] == 'planned':
+            self.planned[slot] = record
+            self.completed.discard(slot)
+        elif record['event'] == 'completed':
+            self.completed.add(slot)
+
+    def _write(self, records):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a+')
+                self.file.seek(0, os.SEEK_END)
+                if self.file.tell():
+                    self.file.seek(-1, os.SEEK_END)
+                    if self.file.read(1) != '\n':
+                        self.file.write('\n')
+            for record in records:
+                self._apply(record)
+                self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def plan(self, moves):
+        self._write([{
+            'event': 'planned',
+            'slot': slot,
+            'src': src.name,
+            'src_addr': '{}:{}'.format(src.host, src.port),
+            'dst': dst.name,
+            'dst_addr': '{}:{}'.format(dst.host, dst.port),
+        } for src, dst, slot in moves])
+
+    def complete(self, src, dst, slot):
+        self._write([{
+            'event': 'completed',
+            'slot': slot,
+            'src': src.name,
+            'dst': dst.name,
+        }])
+
+    def pending(self):
+        with self.lock:
+            return [record for slot, record in self.planned.items()
+                    if slot not in self.completed]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
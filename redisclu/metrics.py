@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import threading
+import collections
+
+from utils import echo
+
+BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+
+
+def addr(node):
+    return '{}:{}'.format(node.host, node.port)
+
+
+class PairStats(object):
+    def __init__(self, src, dst):
+        self.src = addr(src)
+        self.dst = addr(dst)
+        self.started = None
+        self.planned_slots = 0
+        self.planned_keys = 0
+        self.slots = 0
+        self.keys = 0
+        self.bytes = 0
+        self.batches = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.retries = collections.Counter()
+
+    def record_batch(self, keys, payload, elapsed, errors):
+        if self.started is None:
+            self.started = time.time() - elapsed
+        self.keys += keys
+        self.bytes += payload
+        self.batches += 1
+        self.latency_sum += elapsed
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+        for error in errors:
+            self.retries[type(error).__name__] += 1
+
+    def snapshot(self):
+        elapsed = time.time() - self.started if self.started else 0
+        keys_per_sec = self.keys / elapsed if elapsed else 0
+        slots_per_sec = self.slots / elapsed if elapsed else 0
+        remaining_keys = max(self.planned_keys - self.keys, 0)
+        remaining_slots = max(self.planned_slots - self.slots, 0)
+        if keys_per_sec and remaining_keys:
+            eta = remaining_keys / keys_per_sec
+        elif slots_per_sec:
+            eta = remaining_slots / slots_per_sec
+        else:
+            eta = None
+        return {
+            'src': self.src,
+            'dst': self.dst,
+            'slots': self.slots,
+            'planned_slots': self.planned_slots,
+            'keys': self.keys,
+            'planned_keys': self.planned_keys,
+            'bytes': self.bytes,
+            'batches': self.batches,
+            'keys_per_sec': round(keys_per_sec, 2),
+            'bytes_per_sec': round(self.bytes / elapsed if elapsed else 0, 2),
+            'eta': round(eta, 1) if eta is not None else None,
+            'latency': {
+                'sum': round(self.latency_sum, 6),
+                'count': self.batches,
+                'buckets': dict(zip(BUCKETS, self.buckets)),
+            },
+            'retries': dict(self.retries),
+        }
+
+
+class MigrationMetrics(object):
+    """
+    Throughput, batch latency, ASK/MOVED retries and ETA of every
+    source -> destination pair of a migration.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pairs = collections.OrderedDict()
+
+    def _pair(self, src, dst):
+        key = (addr(src), addr(dst))
+        stats = self.pairs.get(key)
+        if stats is None:
+            stats = self.pairs[key] = PairStats(src, dst)
+        return stats
+
+    def plan(self, src, dst, slots):
+        with self.lock:
+            stats = self._pair(src, dst)
+            stats.planned_slots += len(slots)
+            stats.planned_keys += sum(src.key_counts.get(s, 0) for s in slots)
+
+    def record_batch(self, src, dst, keys, payload, elapsed, errors=()):
+        with self.lock:
+            self._pair(src, dst).record_batch(keys, payload, elapsed, errors)
+
+    def record_slot(self, src, dst):
+        with self.lock:
+            self._pair(src, dst).slots += 1
+
+    def snapshot(self):
+        with self.lock:
+            return [stats.snapshot() for stats in self.pairs.values()]
+
+    def show(self):
+        for s in self.snapshot():
+            eta = '{}s'.format(s['eta']) if s['eta'] is not None else '-'
+            echo('{src} -> {dst} slots: {slots}/{planned_slots} '
+                 'keys: {keys}/{planned_keys} {keys_per_sec} keys/s '
+                 '{bytes_per_sec} bytes/s eta: {eta}'.format(
+                     **dict(s, eta=eta)),
+                 color='blue')
+
+    def write(self, path):
+        """
+        Write metrics atomically, as a Prometheus textfile if path ends
+        with .prom otherwise as JSON.
+        """
+        snapshot = self.snapshot()
+        if path.endswith('.prom'):
+            data = self.prometheus(snapshot)
+        else:
+            data = json.dumps({'time': time.time(), 'pairs': snapshot},
+                              sort_keys=True)
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def prometheus(self, snapshot):
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP redisclu_{} {}'.format(name, doc))
+            lines.append('# TYPE redisclu_{} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('redisclu_{}{{{}}} {}'.format(
+                    name, ','.join('{}="{}"'.format(k, v)
+                                   for k, v in labels), value))
+
+        def pair(s, *extra):
+            return (('src', s['src']), ('dst', s['dst'])) + extra
+
+        for name, field, doc in (
+                ('migrated_slots_total', 'slots', 'Slots migrated'),
+                ('migrated_keys_total', 'keys', 'Keys migrated'),
+                ('migrated_bytes_total', 'bytes', 'Estimated bytes migrated')):
+            metric(name, 'counter', doc,
+                   [(pair(s), s[field]) for s in snapshot])
+
+        metric('migration_retries_total', 'counter',
+               'ASK/MOVED replies while migrating',
+               [(pair(s, ('error', error)), count) for s in snapshot
+                for error, count in sorted(s['retries'].items())])
+
+        for name, field, doc in (
+                ('migration_keys_per_second', 'keys_per_sec', 'Keys per second'),
+                ('migration_bytes_per_second', 'bytes_per_sec',
+                 'Estimated bytes per second'),
+                ('migration_eta_seconds', 'eta', 'Estimated time left')):
+            metric(name, 'gauge', doc,
+                   [(pair(s), s[field]) for s in snapshot
+                    if s[field] is not None])
+
+        name = 'redisclu_migration_batch_seconds'
+        lines.append('# HELP {} MIGRATE batch latency'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for s in snapshot:
+            labels = 'src="{}",dst="{}"'.format(s['src'], s['dst'])
+            latency = s['latency']
+            for bound in BUCKETS:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, bound, latency['buckets'][bound]))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                name, labels, latency['count']))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, latency['sum']))
+            lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                   latency['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class Reporter(object):
+    """
+    Print progress and write the metrics file every `interval` seconds
+    while a migration runs.
+    """
+
+    def __init__(self, metrics, path=None, progress=False, interval=1):
+        self.metrics = metrics
+        self.path = path
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.path or self.progress)
+
+    def report(self):
+        if self.progress:
+            self.metrics.show()
+        if self.path:
+            self.metrics.write(self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.report()
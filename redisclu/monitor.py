@@ -0,0 +1,151 @@
+import json
+import time
+
+from redis.exceptions import (ConnectionError, TimeoutError)
+from node import Node
+from status import (ClusterStatus, keyspace_keys)
+from utils import echo
+
+
+def role(record):
+    return 'master' if 'master' in record.flags else 'slave'
+
+
+def link(record):
+    failing = [f for f in record.flags if f in ('fail', 'fail?')]
+    return ','.join([record.link_status] + failing)
+
+
+class Monitor(object):
+    """
+    Poll topology and INFO every `interval` seconds over the same
+    connections and report what changed since the previous sample.
+    """
+
+    def __init__(self, node, interval=1, timeout=2):
+        self.node = node
+        self.interval = interval
+        self.timeout = timeout
+        self.previous = None
+        self.lines = {}
+
+    def sample(self):
+        return ClusterStatus(self.node, timeout=self.timeout).collect()
+
+    def switch_node(self):
+        """
+        Poll another node of the last sample, the current one failed.
+        """
+        if self.previous is None:
+            return
+        for r in self.previous.records:
+            if r.link_status == 'disconnected' or \
+                    r.addr == '{}:{}'.format(self.node.host, self.node.port):
+                continue
+            try:
+                self.node = Node.from_uri(r.addr)
+            except (ConnectionError, TimeoutError):
+                continue
+            echo('Polling {} instead'.format(self.node), color='yellow')
+            return
+
+    def diff(self, prev, cur):
+        before = dict((r.name, r) for r in prev.records)
+        after = dict((r.name, r) for r in cur.records)
+        elapsed = (cur.collected_at - prev.collected_at) or 1
+        delta = {
+            'time': cur.collected_at,
+            'elapsed': round(elapsed, 3),
+            'joined': [after[n].addr for n in after if n not in before],
+            'left': [before[n].addr for n in before if n not in after],
+            'roles': [],
+            'links': [],
+            'slots': [],
+            'nodes': {},
+        }
+        for name, r in after.items():
+            old = before.get(name)
+            if old is None:
+                continue
+            if role(old) != role(r):
+                delta['roles'].append((r.addr, role(old), role(r)))
+            if link(old) != link(r):
+                delta['links'].append((r.addr, link(old), link(r)))
+            if old.slots != r.slots:
+                delta['slots'].append((r.addr,
+                                       str(r.slots.difference(old.slots)),
+                                       str(old.slots.difference(r.slots))))
+
+        for name, info in cur.infos.items():
+            old = prev.infos.get(name, {})
+            if 'total_commands_processed' in old:
+                ops = (info['total_commands_processed'] -
+                       old['total_commands_processed']) / elapsed
+            else:
+                ops = info.get('instantaneous_ops_per_sec', 0)
+            memory = info.get('used_memory', 0)
+            growth = (memory - old['used_memory']) / elapsed \
+                if 'used_memory' in old else 0
+            delta['nodes'][after[name].addr] = {
+                'ops_per_sec': int(ops),
+                'used_memory': memory,
+                'memory_per_sec': int(growth),
+                'keys': keyspace_keys(info),
+            }
+        delta['unreachable'] = [after[n].addr for n in cur.failures
+                                if n not in prev.failures]
+        return delta
+
+    def show(self, delta):
+        echo(time.strftime('%H:%M:%S', time.localtime(delta['time'])))
+        for addr in delta['joined']:
+            echo('\t{} joined'.format(addr), color='green')
+        for addr in delta['left']:
+            echo('\t{} left'.format(addr), color='red')
+        for addr in delta['unreachable']:
+            echo('\t{} did not answer'.format(addr), color='red')
+        for addr, old, new in delta['roles']:
+            echo('\t{} {} -> {}'.format(addr, old, new), color='yellow')
+        for addr, old, new in delta['links']:
+            echo('\t{} link {} -> {}'.format(addr, old, new), color='yellow')
+        for addr, gained, lost in delta['slots']:
+            echo('\t{} slots +[{}] -[{}]'.format(addr, gained, lost),
+                 color='blue')
+        for addr, stats in sorted(delta['nodes'].items()):
+            line = ('{ops_per_sec} ops/s memory: {used_memory} '
+                    '({memory_per_sec:+d} bytes/s) keys: {keys}'
+                    .format(**stats))
+            # unchanged nodes are not printed again
+            if self.lines.get(addr) != line:
+                self.lines[addr] = line
+                echo('\t{} {}'.format(addr, line))
+
+    def report(self, current, as_json=False):
+        if self.previous is None:
+            if as_json:
+                echo(json.dumps(current.to_dict()))
+            else:
+                current.show()
+        else:
+            delta = self.diff(self.previous, current)
+            if as_json:
+                echo(json.dumps(delta))
+            else:
+                self.show(delta)
+
+    def run(self, count=0, as_json=False):
+        samples = 0
+        while not count or samples < count:
+            started = time.time()
+            try:
+                current = self.sample()
+            except (ConnectionError, TimeoutError) as e:
+                # try again on the next interval
+                echo('{} did not answer: {}'.format(self.node, e), color='red')
+                self.switch_node()
+            else:
+                self.report(current, as_json)
+                self.previous = current
+            samples += 1
+            if not count or samples < count:
+                time.sleep(max(self.interval - (time.time() - started), 0))
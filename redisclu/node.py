@@ -1,28 +1,40 @@
+import time
 import socket
 import redis
 import urlparse
+import threading
+import collections
 
+from redis.exceptions import (ResponseError, TimeoutError)
 from exceptions import (AskError, MovedError)
+from slots import SlotRanges
+from topology import (Topology, invalidates_topology, parse_nodes)
 from utils import echo
 
 
 class Node(object):
     ignored_exceptions = (AskError, MovedError)
+    migrate_timeout = 15000
 
     def __init__(self, host='localhost', port=6379, socket_timeout=4):
         self.host = socket.gethostbyname(host)
         self.port = port
         self.redis = redis.Redis(host, port, socket_timeout=socket_timeout)
         self.redis.ping()
-        self.pipeline = self.redis.pipeline(transaction=False)
+        self.topology = Topology(self)
         self.attempts = []
+        self.key_counts = {}
+        self.key_batch = None
+        self._name = None
+        self._slow_clients = {}
+        self._slow_lock = threading.Lock()
 
     @classmethod
     def from_uri(cls, uri):
         if not uri.startswith('redis://'):
             uri = 'redis://{}'.format(uri)
         d = urlparse.urlparse(uri)
-        return cls(d.hostname, d.port)
+        return registry.get(d.hostname, d.port or 6379)
 
     def __repr__(self):
         return 'Node<{}:{}>'.format(self.host, self.port)
@@ -46,8 +58,7 @@ class Node(object):
 
     @property
     def node_info(self):
-        nodes = self.nodes()
-        return nodes[0]
+        return self.topology.myself
 
     @property
     def slots(self):
@@ -55,69 +66,358 @@ class Node(object):
 
     @property
     def name(self):
-        return self.node_info['name']
+        # node id only changes on hard reset
+        if self._name is None:
+            self._name = self.node_info['name']
+        return self._name
 
     def migrate_keys(self, host, port, keys):
+        # pipeline per call, migrations may run concurrently on this node
+        pipeline = self.redis.pipeline(transaction=False)
         for key in keys:
-            self.pipeline.execute_command('MIGRATE', host, port, key, 0, 15000)
-        return self.pipeline.execute(raise_on_error=False)
+            pipeline.execute_command('MIGRATE', host, port, key, 0,
+                                     self.migrate_timeout)
+        return pipeline.execute(raise_on_error=False)
+
+    def migrate_big_key(self, host, port, key, timeout):
+        """
+        MIGRATE a single key with a `timeout` ms MIGRATE timeout.
+
+        That timeout is an inactivity timeout on the server, a slow but
+        progressing transfer can take longer, so the client waits twice
+        as long.
+        """
+        with self._slow_lock:
+            client = self._slow_clients.get(timeout)
+            if client is None:
+                client = self._slow_clients[timeout] = redis.Redis(
+                    self.host, self.port, socket_timeout=timeout * 2 / 1000.0)
+        return client.execute_command('MIGRATE', host, port, key, 0, timeout)
+
+    def find_big_keys(self, keys, threshold, samples=5):
+        """
+        MEMORY USAGE and OBJECT ENCODING of keys in one pipeline.
+
+        Returns ({key: bytes}, [(key, bytes, encoding)] of keys of at
+        least `threshold` bytes).
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.execute_command('MEMORY USAGE', key, 'SAMPLES', samples)
+            pipeline.execute_command('OBJECT ENCODING', key)
+        results = iter(pipeline.execute(raise_on_error=False))
 
-    def migrate_slot(self, dst, slot, cluster):
-        dst.set_slot('IMPORTING', slot, self.name)
-        self.set_slot('MIGRATING', slot, dst.name)
+        sizes, big = {}, []
+        for key in keys:
+            size, encoding = next(results), next(results)
+            size = size if isinstance(size, (int, long)) else 0
+            sizes[key] = size
+            if size >= threshold:
+                big.append((key, size, encoding))
+        return sizes, big
+
+    def _move_big_keys(self, dst, pending, payloads, totals, cluster):
+        """
+        Take keys of at least `cluster.big_key_bytes` out of the fetched
+        batches and move them one by one with `cluster.big_key_timeout`,
+        the rest keep the pipelined path.
+        """
+        keys = [key for batch in pending.values() if batch for key in batch]
+        if not keys:
+            return
+        sizes, big = self.find_big_keys(keys, cluster.big_key_bytes)
+        big = dict((key, (size, encoding)) for key, size, encoding in big)
 
-        total_keys = 0
-        for keys in self._scan_keys(slot, cluster.key_migration_count):
-            results = self.migrate_keys(dst.host, dst.port, keys)
-            self.attempts.extend(filter(lambda r: any(
-                isinstance(r, e) for e in self.ignored_exceptions), results))
-            total_keys += len(keys)
+        for slot, batch in pending.items():
+            if not batch:
+                continue
+            small = [key for key in batch if key not in big]
+            payloads[slot] = sum(sizes[key] for key in small)
+            # refetch if only big keys were left
+            pending[slot] = small or None
+            for key in batch:
+                if key not in big:
+                    continue
+                size, encoding = big[key]
+                if cluster.throttle:
+                    cluster.throttle.acquire(self, 1, size)
+                started = time.time()
+                errors, failed = [], None
+                while True:
+                    try:
+                        self.migrate_big_key(dst.host, dst.port, key,
+                                             cluster.big_key_timeout)
+                    except self.ignored_exceptions as e:
+                        errors.append(e)
+                    except TimeoutError as e:
+                        cluster.retry_policy.backoff(self, [slot], e)
+                        continue
+                    except ResponseError as e:
+                        if not str(e).startswith('IOERR'):
+                            # e.g. BUSYKEY, the key stays on the source
+                            failed = e
+                            break
+                        # the server side MIGRATE timeout fired first
+                        cluster.retry_policy.backoff(self, [slot],
+                                                     TimeoutError(str(e)))
+                        continue
+                    break
+                elapsed = time.time() - started
+                if failed is not None:
+                    self.attempts.append(failed)
+                    echo('big key {} not migrated from {} to {}: {}'.format(
+                        key, self, dst, failed), color='red')
+                    continue
+                self.attempts.extend(errors)
+                cluster.metrics.record_batch(self, dst, 1, size, elapsed,
+                                             errors)
+                totals[slot] += 1
+                echo('big key {} ({} bytes, {}) migrated from {} to {} in '
+                     '{:.2f}s'.format(key, size, encoding, self, dst,
+                                      elapsed), color='yellow')
 
-        echo('{} key(s) migrated from {} to {} in slot {}'.format(
-            total_keys, self, dst, slot))
+    def migrate_slot(self, dst, slot, cluster):
+        self.migrate_slots(dst, [slot], cluster)
+
+    def migrate_slots(self, dst, slots, cluster):
+        """
+        Move several slots at once. They are opened together and every
+        round migrates the last fetched keys of each open slot and fetches
+        the next ones in a single pipeline, so a near-empty slot costs
+        about the same as a single batch.
+        """
+        dst.set_slots('IMPORTING', slots, self.name)
+        self.set_slots('MIGRATING', slots, dst.name)
+
+        single = cluster.key_migration_mode != 'keys'
+        batch = cluster.key_batch(self)
+        pending = collections.OrderedDict((slot, None) for slot in slots)
+        totals = dict((slot, 0) for slot in slots)
+        payloads = {}
+        while pending:
+            # keys of one round are shared by all open slots
+            count = max(batch.size // len(pending), 1)
+            pipeline = self.redis.pipeline(transaction=False)
+            for slot, keys in pending.items():
+                if keys and single:
+                    for key in keys:
+                        pipeline.execute_command('MIGRATE', dst.host,
+                                                 dst.port, key, 0,
+                                                 self.migrate_timeout)
+                elif keys:
+                    pipeline.execute_command('MIGRATE', dst.host, dst.port,
+                                             '', 0, self.migrate_timeout,
+                                             'KEYS', *keys)
+                pipeline.execute_command('CLUSTER GETKEYSINSLOT', slot, count)
+
+            fetched = sum(len(keys) for keys in pending.values() if keys)
+            if cluster.big_key_bytes:
+                # measured by _move_big_keys
+                measured = sum(payloads.get(slot, 0) for slot, keys in
+                               pending.items() if keys)
+                payload = measured
+            else:
+                measured = None
+                payload = fetched * (batch.key_bytes or 0)
+            if fetched and cluster.throttle:
+                cluster.throttle.acquire(self, fetched, payload)
+            started = time.time()
+            try:
+                results = iter(pipeline.execute(raise_on_error=False))
+            except TimeoutError as e:
+                # retry the round with a smaller batch, keys which were
+                # not moved are fetched again
+                batch.shrink()
+                cluster.retry_policy.backoff(self, list(pending), e)
+                for slot in pending:
+                    pending[slot] = None
+                continue
+            elapsed = time.time() - started
+
+            moved, errors, done = 0, [], []
+            for slot, keys in pending.items():
+                retry = False
+                if keys:
+                    replies = [next(results)
+                               for _ in range(len(keys) if single else 1)]
+                    failed = [r for r in replies if isinstance(r, Exception)]
+                    if not single and failed and not isinstance(
+                            failed[0], self.ignored_exceptions):
+                        # batch failed, move key by key and fetch again
+                        self.attempts.append(failed[0])
+                        replies = self.migrate_keys(dst.host, dst.port, keys)
+                        retry = True
+                    errors.extend(r for r in replies
+                                  if isinstance(r, self.ignored_exceptions))
+                    moved += len(keys)
+                    totals[slot] += len(keys)
+
+                next_keys = next(results)
+                if isinstance(next_keys, Exception):
+                    raise next_keys
+                if retry:
+                    pending[slot] = None
+                elif next_keys:
+                    pending[slot] = next_keys
+                else:
+                    done.append(slot)
+
+            if moved:
+                batch.update(moved, elapsed, measured)
+                self.attempts.extend(errors)
+                cluster.metrics.record_batch(self, dst, moved, payload,
+                                             elapsed, errors)
+            for slot in done:
+                pending.pop(slot)
+                self.key_counts.pop(slot, None)
+                dst.key_counts[slot] = totals[slot]
+            if cluster.big_key_bytes:
+                self._move_big_keys(dst, pending, payloads, totals, cluster)
+            if not done:
+                continue
 
-        cluster.update_slot_mapping(slot, dst.name)
+            if len(done) == 1:
+                where = 'slot {}'.format(done[0])
+            else:
+                where = 'slots {}'.format(SlotRanges.from_slots(done))
+            echo('{} key(s) migrated from {} to {} in {} (batch size {})'
+                 .format(sum(totals[s] for s in done), self, dst, where,
+                         batch.size))
+            cluster.update_slots_mapping(done, dst.name, self.name)
 
+    @invalidates_topology
     def reset(self, hard=False):
         args = []
         if hard:
             args = ['HARD']
+            self._name = None
         return self.execute_command('CLUSTER RESET', *args)
 
+    @invalidates_topology
     def set_slot(self, action, slot, node_id=None):
         remain = [node_id] if node_id else []
         return self.execute_command('CLUSTER SETSLOT', slot, action, *remain)
 
+    @invalidates_topology
+    def set_slots(self, action, slots, node_id=None):
+        """
+        SETSLOT every slot in one pipeline.
+        """
+        remain = [node_id] if node_id else []
+        pipeline = self.redis.pipeline(transaction=False)
+        for slot in slots:
+            pipeline.execute_command('CLUSTER SETSLOT', slot, action, *remain)
+        return pipeline.execute()
+
     def get_keys_in_slot(self, slot, count):
         return self.execute_command('CLUSTER GETKEYSINSLOT', slot, count)
 
     def count_keys_in_slot(self, slot):
         return self.execute_command('CLUSTER COUNTKEYSINSLOT', slot)
 
+    def average_key_size(self):
+        keys = self.dbsize()
+        if not keys:
+            return None
+        return self.info('memory')['used_memory'] / keys
+
+    def count_keys_in_slots(self, slots, refresh=False):
+        """
+        Count keys of all given slots in one pipeline. Counts are cached on
+        the node, only slots which are not known yet are queried unless
+        `refresh` is set.
+        """
+        if refresh:
+            missing = list(slots)
+        else:
+            missing = [s for s in slots if s not in self.key_counts]
+        if missing:
+            pipeline = self.redis.pipeline(transaction=False)
+            for slot in missing:
+                pipeline.execute_command('CLUSTER COUNTKEYSINSLOT', slot)
+            self.key_counts.update(zip(missing, pipeline.execute()))
+        return dict((s, self.key_counts[s]) for s in slots)
+
+    def sample_memory_usage(self, slots, samples=5):
+        """
+        Average MEMORY USAGE of up to `samples` keys of every slot.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for slot in slots:
+            pipeline.execute_command('CLUSTER GETKEYSINSLOT', slot, samples)
+        keys = pipeline.execute()
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for slot_keys in keys:
+            for key in slot_keys:
+                pipeline.execute_command('MEMORY USAGE', key)
+        usage = iter(pipeline.execute(raise_on_error=False))
+
+        result = {}
+        for slot, slot_keys in zip(slots, keys):
+            sizes = [next(usage) for _ in slot_keys]
+            sizes = [s for s in sizes
+                     if s is not None and not isinstance(s, Exception)]
+            result[slot] = sum(sizes) / len(sizes) if sizes else 0
+        return result
+
     def slaves(self, node_id):
         data = self.execute_command('CLUSTER SLAVES', node_id)
         return self._parse_node('\n'.join(data))
 
+    @invalidates_topology
     def add_slots(self, *slot):
         if not slot:
             return
         self.execute_command('CLUSTER ADDSLOTS', *slot)
 
+    @invalidates_topology
+    def add_slots_range(self, *ranges):
+        """
+        ranges: inclusive (start, end) pairs, ADDSLOTS on servers which do
+        not know ADDSLOTSRANGE (< 7.0).
+        """
+        if not ranges:
+            return
+        try:
+            self.execute_command('CLUSTER ADDSLOTSRANGE',
+                                 *[i for r in ranges for i in r])
+        except ResponseError as e:
+            # 5.0-6.2: ERR Unknown subcommand ..., older: ERR Wrong CLUSTER
+            # subcommand or number of arguments
+            if 'subcommand' not in str(e).lower():
+                raise
+            self.add_slots(*[s for start, end in ranges
+                             for s in range(start, end + 1)])
+
+    @invalidates_topology
     def forget(self, node_id):
         return self.execute_command('CLUSTER FORGET', node_id)
 
+    @invalidates_topology
     def set_config_epoch(self, config_epoch):
         return self.execute_command('CLUSTER SET-CONFIG-EPOCH', config_epoch)
 
+    @invalidates_topology
     def meet(self, ip, port):
         return self.execute_command('CLUSTER MEET', ip, port)
 
+    @invalidates_topology
+    def meet_many(self, addrs):
+        """
+        MEET every (ip, port) in one pipeline.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for ip, port in addrs:
+            pipeline.execute_command('CLUSTER MEET', ip, port)
+        return pipeline.execute()
+
+    @invalidates_topology
     def replicate(self, node_id):
         return self.execute_command('CLUSTER REPLICATE', node_id)
 
     def nodes(self):
-        info = self.execute_command('CLUSTER NODES').strip()
-        return self._parse_node(info)
+        return self.topology.refresh()
 
     def cluster_info(self):
         data = {}
@@ -130,49 +430,66 @@ class Node(object):
         return data
 
     def _parse_node(self, nodes):
-        data = []
-        for item in nodes.split('\n'):
-            if not item:
-                continue
-            confs = item.split()
-            node_info = {
-                'name': confs[0],
-                'addr': confs[1],
-                'flags': confs[2].split(','),
-                'replicate': confs[3],  # master_id
-                'ping_sent': int(confs[4]),
-                'ping_recv': int(confs[5]),
-                'link_status': confs[7],
-                'migrating': {},
-                'importing': {},
-                'slots': []
-            }
-            for slot in confs[8:]:
-                if slot[0] == '[':
-                    if '->-' in slot:
-                        s, dst = slot[1:-1].split('->-')
-                        node_info['migrating'][s] = dst
-                    elif '-<-' in slot:
-                        s, src = slot[1:-1].split('-<-')
-                        node_info['importing'][s] = src
-                elif '-' in slot:
-                    start, end = slot.split('-')
-                    node_info['slots'].extend(range(int(start), int(end) + 1))
-                else:
-                    node_info['slots'].append(int(slot))
-
-            if 'myself' in node_info['flags']:
-                data.insert(0, node_info)
-            else:
-                data.append(node_info)
-        return data
+        return parse_nodes(nodes)
 
-    def _scan_keys(self, slot, count):
+    def _scan_keys(self, slot, batch):
         while True:
-            keys = self.get_keys_in_slot(slot, count)
+            keys = self.get_keys_in_slot(slot, batch.size)
             if not keys:
                 break
             yield keys
 
 
-class MockNode(object): pass
+class NodeRegistry(object):
+    """
+    One Node, and so one connection pool, per host:port.
+
+    Host names are resolved and nodes are pinged only once, every Node
+    object for an address is shared between clusters and threads. Nodes
+    of different addresses are built concurrently.
+    """
+
+    def __init__(self):
+        # created on first use, after backends.use() patched threading
+        self._lock = None
+        self.pending = {}
+        self.nodes = {}
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = threading.Lock()
+        return self._lock
+
+    def get(self, host, port):
+        key = (host, port)
+        with self.lock:
+            node = self.nodes.get(key)
+            if node is not None:
+                return node
+            address_lock = self.pending.setdefault(key, threading.Lock())
+
+        with address_lock:
+            with self.lock:
+                node = self.nodes.get(key)
+            if node is not None:
+                return node
+
+            ip = socket.gethostbyname(host)
+            with self.lock:
+                node = self.nodes.get((ip, port))
+            if node is None:
+                node = Node(ip, port)
+            with self.lock:
+                node = self.nodes.setdefault((ip, port), node)
+                self.nodes[key] = node
+                self.pending.pop(key, None)
+            return node
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.nodes.clear()
+
+
+registry = NodeRegistry()
@@ -0,0 +1,99 @@
+import collections
+
+from utils import echo
+
+WEIGHTS = ('slots', 'keys', 'bytes')
+
+
+class Move(collections.namedtuple('Move', 'src dst slot keys bytes')):
+    pass
+
+
+class Plan(object):
+    def __init__(self, weight, moves, before, after):
+        self.weight = weight
+        self.moves = moves
+        self.before = before
+        self.after = after
+
+    @property
+    def cost(self):
+        return {
+            'slots': len(self.moves),
+            'keys': sum(m.keys for m in self.moves),
+            'bytes': sum(m.bytes for m in self.moves),
+        }
+
+    def show(self):
+        pairs = collections.OrderedDict()
+        for move in self.moves:
+            pairs.setdefault((move.src, move.dst), []).append(move)
+        for (src, dst), moves in pairs.items():
+            echo('{} -> {}: {} slot(s), {} key(s), {} byte(s)'.format(
+                src, dst, len(moves), sum(m.keys for m in moves),
+                sum(m.bytes for m in moves)))
+
+        echo('Balance by {}:'.format(self.weight))
+        for node in sorted(self.before, key=lambda n: self.before[n],
+                           reverse=True):
+            echo('\t{} {} -> {}'.format(node, self.before[node],
+                                        self.after[node]))
+        cost = self.cost
+        echo('Estimated cost: {slots} slot(s), {keys} key(s), '
+             '{bytes} byte(s)'.format(**cost), color='yellow')
+
+
+def weigh(weight, keys, size):
+    if weight == 'slots':
+        return 1
+    if weight == 'keys':
+        return keys
+    return size
+
+
+def plan(stats, weight='bytes', threshold=0.05):
+    """
+    Plan slot moves which bring every master within `threshold` of the
+    average load by `weight` while moving as few bytes as possible.
+
+    stats: {node: {slot: (keys, bytes)}}
+    """
+    assert weight in WEIGHTS
+    nodes = list(stats)
+    loads = dict((node, sum(weigh(weight, k, b) for k, b in slots.values()))
+                 for node, slots in stats.items())
+    before = dict(loads)
+    if not nodes:
+        return Plan(weight, [], before, loads)
+
+    target = sum(loads.values()) / float(len(nodes))
+    slack = target * threshold
+
+    moves = []
+    for donor in sorted(nodes, key=lambda n: loads[n], reverse=True):
+        if loads[donor] <= target + slack:
+            continue
+
+        # cheapest slots per unit of weight first
+        candidates = []
+        for slot, (keys, size) in stats[donor].items():
+            w = weigh(weight, keys, size)
+            if w > 0:
+                candidates.append(((size, keys) if weight == 'slots' else
+                                   (size / float(w), keys / float(w)),
+                                   slot, keys, size, w))
+        candidates.sort()
+
+        for _, slot, keys, size, w in candidates:
+            if loads[donor] <= target + slack:
+                break
+            if loads[donor] - w < target - slack:
+                continue
+            receiver = min(nodes, key=lambda n: loads[n])
+            if receiver is donor or loads[receiver] + w > target + slack:
+                continue
+            moves.append(Move(donor, receiver, slot, keys, size))
+            loads[donor] -= w
+            loads[receiver] += w
+
+    return Plan(weight, moves, before, loads)
@@ -0,0 +1,107 @@
+import bisect
+import itertools
+
+
+class SlotRanges(object):
+    """
+    Sorted, non-overlapping (start, end) slot ranges, both ends inclusive.
+
+    Behaves like a sorted sequence of slot numbers without expanding it.
+    """
+    __slots__ = ('ranges', '_starts', '_count')
+
+    def __init__(self, ranges=()):
+        self.ranges = self._merge(ranges)
+        self._starts = [start for start, _ in self.ranges]
+        self._count = sum(end - start + 1 for start, end in self.ranges)
+
+    @classmethod
+    def full(cls, hash_slots):
+        return cls([(0, hash_slots - 1)])
+
+    @classmethod
+    def from_slots(cls, slots):
+        return cls((slot, slot) for slot in slots)
+
+    @staticmethod
+    def _merge(ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            for slot in itertools.islice(itertools.count(start),
+                                         end - start + 1):
+                yield slot
+
+    def __contains__(self, slot):
+        i = bisect.bisect_right(self._starts, slot) - 1
+        return i >= 0 and slot <= self.ranges[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, SlotRanges) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return ','.join(str(start) if start == end else
+                        '{}-{}'.format(start, end)
+                        for start, end in self.ranges)
+
+    def __repr__(self):
+        return 'SlotRanges<{}>'.format(self)
+
+    def union(self, *others):
+        ranges = list(self.ranges)
+        for other in others:
+            ranges.extend(other.ranges)
+        return SlotRanges(ranges)
+
+    def difference(self, other):
+        result, others = [], other.ranges
+        j = 0
+        for start, end in self.ranges:
+            while j < len(others) and others[j][1] < start:
+                j += 1
+            current, k = start, j
+            while k < len(others) and others[k][0] <= end:
+                other_start, other_end = others[k]
+                if other_start > current:
+                    result.append((current, other_start - 1))
+                current = max(current, other_end + 1)
+                k += 1
+            if current <= end:
+                result.append((current, end))
+        return SlotRanges(result)
+
+    def split(self, counts):
+        """
+        Split into consecutive chunks holding `counts` slots each.
+        """
+        chunks, ranges = [], list(self.ranges)
+        i = 0
+        for count in counts:
+            chunk = []
+            while count > 0 and i < len(ranges):
+                start, end = ranges[i]
+                size = end - start + 1
+                if size <= count:
+                    chunk.append((start, end))
+                    count -= size
+                    i += 1
+                else:
+                    chunk.append((start, start + count - 1))
+                    ranges[i] = (start + count, end)
+                    count = 0
+            chunks.append(SlotRanges(chunk))
+        return chunks
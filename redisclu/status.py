@@ -0,0 +1,103 @@
+import time
+import collections
+
+from cluster import Cluster
+from node import Node
+from utils import (echo, gather)
+
+
+def keyspace(info):
+    return dict((k, v) for k, v in info.items()
+                if k.startswith('db') and isinstance(v, dict))
+
+
+def keyspace_keys(info):
+    return sum(v.get('keys', 0) for v in keyspace(info).values())
+
+
+class ClusterStatus(object):
+    """
+    Cluster layout from a single CLUSTER NODES reply plus INFO of every
+    node, fetched concurrently. Nodes which do not answer within `timeout`
+    seconds are listed as unreachable.
+    """
+
+    def __init__(self, node, timeout=2):
+        self.node = node
+        self.timeout = timeout
+        self.records = []
+        self.replicas = {}
+        self.infos = {}
+        self.failures = {}
+        self.collected_at = None
+
+    def collect(self):
+        self.records = self.node.nodes()
+        self.replicas = collections.defaultdict(list)
+        for r in self.records:
+            self.replicas[r.replicate].append(r)
+        connected = [r for r in self.records
+                     if r.link_status != 'disconnected']
+        infos, failures = gather(lambda r: Node.from_uri(r.addr).info(),
+                                 connected, timeout=self.timeout)
+        self.infos = dict((r.name, info) for r, info in infos.items())
+        self.failures = dict((r.name, e) for r, e in failures.items())
+        self.collected_at = time.time()
+        return self
+
+    @property
+    def masters(self):
+        return [r for r in self.records if 'master' in r.flags]
+
+    def slaves(self, name):
+        return self.replicas.get(name, [])
+
+    @property
+    def covered_slots(self):
+        return sum(len(r.slots) for r in self.masters)
+
+    @property
+    def healthy(self):
+        return self.covered_slots == Cluster.CLUSTER_HASH_SLOTS
+
+    def to_dict(self):
+        masters = []
+        for r in self.masters:
+            info = self.infos.get(r.name, {})
+            masters.append({
+                'name': r.name,
+                'addr': r.addr,
+                'flags': r.flags,
+                'link_status': r.link_status,
+                'slots': len(r.slots),
+                'slot_ranges': str(r.slots),
+                'slaves': [s.addr for s in self.slaves(r.name)],
+                'keys': keyspace_keys(info),
+                'used_memory': info.get('used_memory'),
+            })
+        return {
+            'collected_at': self.collected_at,
+            'masters': masters,
+            'slaves': len(self.records) - len(masters),
+            'covered_slots': self.covered_slots,
+            'healthy': self.healthy,
+            'unreachable': dict((name, str(e))
+                                for name, e in self.failures.items()),
+        }
+
+    def show(self):
+        for r in self.masters:
+            slaves = ','.join(s.addr for s in self.slaves(r.name))
+            echo('{} {} {} {}'.format(r.name, r.addr, len(r.slots), slaves))
+        echo('Masters:', len(self.masters))
+        echo('Slaves:', len(self.records) - len(self.masters))
+        echo('Covered Slots:', self.covered_slots)
+        for name, e in self.failures.items():
+            echo('{} did not answer: {}'.format(name, e), color='red')
+
+    def show_keyspace(self):
+        for r in self.masters:
+            echo(r.addr)
+            echo('===========================')
+            echo(keyspace(self.infos.get(r.name, {})))
+            echo('\n')
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import signal
+import threading
+
+from redis.exceptions import (ConnectionError, TimeoutError)
+from utils import echo
+
+
+def scaled(rate, factor):
+    return max(int(rate * factor), 1) if rate else 0
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, at most one second worth of them saved up.
+    A rate of 0 is unlimited.
+    """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def take(self, n):
+        """
+        Take n tokens, returns the seconds to wait before using them.
+        Large requests go into debt which later requests pay back.
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            return -self.tokens / float(self.rate) if self.tokens < 0 else 0
+
+
+class Throttle(object):
+    """
+    Rate limits shared by all migration workers.
+
+    keys: keys per second, bytes: estimated bytes per second, latency: PING
+    round trip (ms) of the source node above which its migration pauses.
+    Limits are re-read from the JSON `control` file when it changes
+    ({"keys": 1000, "bytes": 0, "latency": 5}), SIGUSR1 halves and SIGUSR2
+    doubles the current rates.
+    """
+
+    def __init__(self, keys=0, bytes=0, latency=0, control=None,
+                 probe_interval=1):
+        self.keys = TokenBucket(keys)
+        self.bytes = TokenBucket(bytes)
+        self.latency = latency
+        self.control = control
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked = 0
+        self.probes = {}
+        self.paused = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.keys.rate or self.bytes.rate or self.latency or
+                    self.control)
+
+    def set_limits(self, keys=None, bytes=None, latency=None):
+        if keys is not None:
+            self.keys.set_rate(keys)
+        if bytes is not None:
+            self.bytes.set_rate(bytes)
+        if latency is not None:
+            self.latency = latency
+        echo('Throttle: {} keys/s {} bytes/s latency {} ms'.format(
+            self.keys.rate or '-', self.bytes.rate or '-',
+            self.latency or '-'), color='yellow')
+
+    def scale(self, factor):
+        # 0 means unlimited, a limited rate never scales down to it
+        self.set_limits(keys=scaled(self.keys.rate, factor),
+                        bytes=scaled(self.bytes.rate, factor))
+
+    def install_signals(self):
+        signal.signal(signal.SIGUSR1, lambda *_: self.scale(0.5))
+        signal.signal(signal.SIGUSR2, lambda *_: self.scale(2))
+
+    def reload(self):
+        with self.lock:
+            if not self.control or time.time() - self.checked < 1:
+                return
+            self.checked = time.time()
+            try:
+                mtime = os.path.getmtime(self.control)
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+        try:
+            with open(self.control) as f:
+                limits = json.load(f)
+        except (IOError, ValueError) as e:
+            echo('Throttle: ignoring {}: {}'.format(self.control, e),
+                 color='red')
+            return
+        self.set_limits(**dict((k, limits[k]) for k in
+                               ('keys', 'bytes', 'latency') if k in limits))
+
+    def slow(self, node):
+        """
+        Whether PING to node takes longer than the latency limit, probed at
+        most once per `probe_interval`. A node which does not answer at all
+        is slow too.
+        """
+        now = time.time()
+        with self.lock:
+            probed_at, slow = self.probes.get(node, (0, False))
+            if now - probed_at < self.probe_interval:
+                return slow
+            self.probes[node] = (now, slow)
+        started = time.time()
+        try:
+            node.ping()
+        except (ConnectionError, TimeoutError):
+            slow = True
+        else:
+            slow = (time.time() - started) * 1000 > self.latency
+        with self.lock:
+            self.probes[node] = (time.time(), slow)
+        return slow
+
+    def acquire(self, node, keys, payload=0):
+        """
+        Block until `keys` keys (`payload` bytes) may be migrated from node.
+        """
+        self.reload()
+        started = time.time()
+        while self.latency and self.slow(node):
+            time.sleep(self.probe_interval)
+        wait = max(self.keys.take(keys), self.bytes.take(payload))
+        if wait:
+            time.sleep(wait)
+        with self.lock:
+            self.paused += time.time() - started
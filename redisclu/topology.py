@@ -0,0 +1,155 @@
+import threading
+
+from slots import SlotRanges
+
+
+class Topology(object):
+    """
+    Cached CLUSTER NODES snapshot of a single node.
+
+    The snapshot is served from memory until it is invalidated. Commands
+    which change the cluster layout (SETSLOT, ADDSLOTS, MEET, FORGET...)
+    bump the shared generation, so every snapshot in the process is
+    refreshed on its next access.
+    """
+    # created on first use, after backends.use() patched threading
+    _lock = None
+    generation = 0
+    round_trips = 0
+
+    def __init__(self, node):
+        self.node = node
+        self._nodes = None
+        self._generation = None
+
+    @classmethod
+    def lock(cls):
+        if cls._lock is None:
+            cls._lock = threading.Lock()
+        return cls._lock
+
+    @classmethod
+    def invalidate_all(cls):
+        with cls.lock():
+            cls.generation += 1
+
+    def refresh(self):
+        generation = Topology.generation
+        info = self.node.execute_command('CLUSTER NODES').strip()
+        with Topology.lock():
+            Topology.round_trips += 1
+        self._nodes = self.node._parse_node(info)
+        self._generation = generation
+        return self._nodes
+
+    @property
+    def nodes(self):
+        if self._nodes is None or self._generation != Topology.generation:
+            return self.refresh()
+        return self._nodes
+
+    @property
+    def myself(self):
+        return self.nodes[0]
+
+
+class NodeRecord(object):
+    """
+    One line of CLUSTER NODES.
+
+    Slot fields are kept as the raw tail of the line and decoded on first
+    access, most snapshots are only asked for names, flags and addresses.
+    Items can be read like the former dicts, record['slots'].
+    """
+    __slots__ = ('name', 'addr', 'flags', 'replicate', 'ping_sent',
+                 'ping_recv', 'link_status', '_raw_slots', '_slots',
+                 '_migrating', '_importing')
+
+    def __init__(self, line):
+        confs = line.split(None, 8)
+        self.name = confs[0]
+        self.addr = confs[1].split('@')[0]  # ip:port@cport
+        self.flags = confs[2].split(',')
+        self.replicate = confs[3]  # master_id
+        self.ping_sent = int(confs[4])
+        self.ping_recv = int(confs[5])
+        self.link_status = confs[7]
+        self._raw_slots = confs[8] if len(confs) > 8 else ''
+        self._slots = None
+        self._migrating = None
+        self._importing = None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return 'NodeRecord<{} {}>'.format(self.name, self.addr)
+
+    def _decode(self):
+        ranges, migrating, importing = [], {}, {}
+        for slot in self._raw_slots.split():
+            if slot[0] == '[':
+                if '->-' in slot:
+                    s, dst = slot[1:-1].split('->-')
+                    migrating[s] = dst
+                elif '-<-' in slot:
+                    s, src = slot[1:-1].split('-<-')
+                    importing[s] = src
+            elif '-' in slot:
+                start, end = slot.split('-')
+                ranges.append((int(start), int(end)))
+            else:
+                ranges.append((int(slot), int(slot)))
+        self._slots = SlotRanges(ranges)
+        self._migrating = migrating
+        self._importing = importing
+        self._raw_slots = None
+
+    @property
+    def slots(self):
+        if self._slots is None:
+            self._decode()
+        return self._slots
+
+    @property
+    def migrating(self):
+        if self._migrating is None:
+            self._decode()
+        return self._migrating
+
+    @property
+    def importing(self):
+        if self._importing is None:
+            self._decode()
+        return self._importing
+
+
+def parse_nodes(reply):
+    """
+    [NodeRecord] of a CLUSTER NODES reply, myself first.
+    """
+    data = []
+    myself = None
+    for line in reply.splitlines():
+        if not line:
+            continue
+        record = NodeRecord(line)
+        if myself is None and 'myself' in record.flags:
+            myself = len(data)
+        data.append(record)
+    if myself:
+        data[0], data[myself] = data[myself], data[0]
+    return data
+
+
+def invalidates_topology(f):
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        finally:
+            Topology.invalidate_all()
+
+    return wrapper
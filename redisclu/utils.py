@@ -1,8 +1,11 @@
 from __future__ import print_function
 
 import itertools
+import collections
 import os
 import sys
+import backends
+import concurrent.futures
 
 COLOR_MAP = {
     "red": 31,
@@ -66,4 +69,98 @@ def spread(nodes, n):
             target.append(node_group.pop(0))
             if len(target) >= n:
                 break
-    return target
\ No newline at end of file
+    return target
+
+
+def place_replicas(masters, nodes, replicas):
+    """Pick `replicas` slaves per master out of nodes
+
+    A slave never shares a host with its master or with another slave of
+    the same master, hosts with the most spare nodes and the fewest
+    slaves so far are picked first to even out replication traffic.
+    Masters the greedy pass leaves short take a slave over from another
+    master which can be served from a different host, so slaves are only
+    unplaced when no placement satisfies the constraints.
+    Returns ({master: [slave]}, unplaced count).
+    """
+    spare = collections.OrderedDict()
+    for node in nodes:
+        spare.setdefault(node.host, []).append(node)
+    load = collections.Counter()
+    placement = collections.OrderedDict((m, []) for m in masters)
+
+    def used(master):
+        return set([master.host] + [s.host for s in placement[master]])
+
+    def take(master):
+        hosts = [h for h, group in spare.items()
+                 if group and h not in used(master)]
+        if not hosts:
+            return False
+        host = min(hosts, key=lambda h: (load[h], -len(spare[h])))
+        placement[master].append(spare[host].pop(0))
+        load[host] += 1
+        return True
+
+    def augment(master, seen):
+        # augmenting path: master takes the slave another master has on a
+        # host it does not use yet, that master takes another host
+        if take(master):
+            return True
+        for host in [h for h in spare if h not in used(master) | seen]:
+            seen.add(host)
+            for other, slaves in placement.items():
+                slave = next((s for s in slaves if s.host == host), None)
+                if other is master or slave is None:
+                    continue
+                slaves.remove(slave)
+                if augment(other, seen):
+                    placement[master].append(slave)
+                    return True
+                slaves.append(slave)
+        return False
+
+    unplaced = 0
+    for _ in range(replicas):
+        for master in masters:
+            if not take(master) and not augment(master, set()):
+                unplaced += 1
+    return placement, unplaced
+
+
+def fan_out(func, items, max_workers=32):
+    """Call func for every item concurrently, results keep the item order
+    """
+    items = list(items)
+    if not items:
+        return []
+    with backends.executor(min(len(items), max_workers)) as executor:
+        return list(executor.map(func, items))
+
+
+def gather(func, items, timeout=None, max_workers=32):
+    """Call func for every item concurrently
+
+    Returns ({item: result}, {item: exception}). Items which do not answer
+    within `timeout` seconds fail with concurrent.futures.TimeoutError and
+    are not waited for.
+    """
+    results, failures = {}, {}
+    items = list(items)
+    if not items:
+        return results, failures
+
+    executor = backends.executor(min(len(items), max_workers))
+    futures = dict((executor.submit(func, item), item) for item in items)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            failures[futures[future]] = e
+    for future in not_done:
+        future.cancel()
+        failures[futures[future]] = concurrent.futures.TimeoutError(
+            'no reply within {}s'.format(timeout))
+    executor.shutdown(wait=False)
+    return results, failures
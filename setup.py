@@ -30,5 +30,8 @@ setup(
         'hiredis',
         'redis',
         'futures==3.0.3',
-    ]
+    ],
+    extras_require={
+        'gevent': ['gevent'],
+    }
 )
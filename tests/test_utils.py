@@ -0,0 +1,48 @@
+import unittest
+
+from redisclu.utils import place_replicas
+
+
+class Instance(object):
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+
+class PlaceReplicasTest(unittest.TestCase):
+
+    def check(self, placement):
+        for master, slaves in placement.items():
+            hosts = [s.host for s in slaves]
+            self.assertNotIn(master.host, hosts)
+            self.assertEqual(len(hosts), len(set(hosts)))
+
+    def test_spreads_slaves(self):
+        masters = [Instance('a', 6379), Instance('b', 6379)]
+        nodes = [Instance('a', 6380), Instance('b', 6380)]
+        placement, unplaced = place_replicas(masters, nodes, 1)
+        self.assertEqual(unplaced, 0)
+        self.assertEqual([s.host for s in placement[masters[0]]], ['b'])
+        self.assertEqual([s.host for s in placement[masters[1]]], ['a'])
+
+    def test_moves_slave_to_place_all(self):
+        # greedy rounds give a: [c, e], b: [d] and leave b:6380 out
+        masters = [Instance('a', 6379), Instance('b', 6379)]
+        nodes = [Instance('c', 6379), Instance('d', 6379),
+                 Instance('e', 6379), Instance('b', 6380)]
+        placement, unplaced = place_replicas(masters, nodes, 2)
+        self.assertEqual(unplaced, 0)
+        self.assertEqual(sum(len(s) for s in placement.values()), 4)
+        self.check(placement)
+
+    def test_unplaced(self):
+        masters = [Instance('a', 6379)]
+        nodes = [Instance('a', 6380), Instance('b', 6379)]
+        placement, unplaced = place_replicas(masters, nodes, 2)
+        self.assertEqual(unplaced, 1)
+        self.assertEqual([s.host for s in placement[masters[0]]], ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()